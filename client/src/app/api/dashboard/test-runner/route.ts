@@ -5,6 +5,9 @@ import { NextRequest, NextResponse } from 'next/server';
 
 import { Run, validateSchema } from './utils';
 
+// Runs of up to this many selected tests go to the interactive queue, so they do not wait behind batch runs
+const INTERACTIVE_MAX_TESTS = Number(process.env.INTERACTIVE_MAX_TESTS ?? 50);
+
 export async function GET() {
   try {
     if (!process.env.MONGODB_SERVICE_URL) {
@@ -84,11 +87,16 @@ export async function POST(req: NextRequest) {
       judges: body['judges'],
     };
 
-    const sentMessageSuccessfully = await sendMessageToQueue('digit_run', payload);
+    const queue =
+      Array.isArray(payload.tests) && payload.tests.length <= INTERACTIVE_MAX_TESTS
+        ? 'digit_run.interactive'
+        : 'digit_run';
+
+    const sentMessageSuccessfully = await sendMessageToQueue(queue, payload);
 
     if (!sentMessageSuccessfully)
       return NextResponse.json(
-        { error: 'Something went wrong while sending data to digit_run queue' },
+        { error: `Something went wrong while sending data to ${queue} queue` },
         { status: 500 },
       );
 
@@ -38,12 +38,15 @@ export async function sendMessageToQueue(queue: string, payload: unknown, multip
 
     await channel.assertQueue(queue, { durable: true });
 
+    // The publish time lets the consumers record how long the message waited in the queue
+    const options = { timestamp: Math.floor(Date.now() / 1000) };
+
     if (multiple) {
       (payload as unknown[]).forEach((m: unknown) => {
-        channel.sendToQueue(queue, Buffer.from(JSON.stringify(m)));
+        channel.sendToQueue(queue, Buffer.from(JSON.stringify(m)), options);
       });
     } else {
-      channel.sendToQueue(queue, Buffer.from(JSON.stringify(payload)));
+      channel.sendToQueue(queue, Buffer.from(JSON.stringify(payload)), options);
     }
 
     await channel.close();
@@ -0,0 +1,83 @@
+"""
+Compares the per-request latency of building a new OpenAI client for every call
+(the old OllamaProvider behaviour) against reusing the shared client from
+'test_runner_service.providers.clients'.
+
+The requests go to a local stub of the chat completions endpoint, so the numbers only
+include the client and connection setup. Against a remote TLS endpoint the gap is larger.
+
+Usage:
+    python benchmarks/client_reuse.py --requests 500
+"""
+import argparse
+import json
+import statistics
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter
+
+from openai import OpenAI
+
+from test_runner_service.providers.clients import get_client
+
+COMPLETION = json.dumps({
+    "id": "chatcmpl-0",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "benchmark",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+}).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def measure(n: int, get: callable) -> list[float]:
+    latencies = []
+
+    for _ in range(n):
+        start = perf_counter()
+        get().chat.completions.create(model="benchmark", messages=[{"role": "user", "content": "hi"}])
+        latencies.append((perf_counter() - start) * 1000)
+
+    return latencies
+
+
+def report(name: str, latencies: list[float]):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<16} mean {statistics.mean(latencies):7.2f} ms   p50 {statistics.median(latencies):7.2f} ms   p95 {p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    report("client per call", measure(args.requests, lambda: OpenAI(base_url=base_url, api_key="ollama")))
+    report("shared client", measure(args.requests, lambda: get_client(("ollama", base_url), lambda: OpenAI(base_url=base_url, api_key="ollama"))))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
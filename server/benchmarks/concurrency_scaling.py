@@ -0,0 +1,85 @@
+"""
+Measures how TestRunnerService throughput scales with the generation/judging concurrency.
+
+The model and the judges are replaced by an in-process provider that sleeps for a fixed
+latency, so the numbers reflect the runner scheduling and not the model itself.
+
+Usage:
+    python benchmarks/concurrency_scaling.py --tests 200 --latency 0.05 --workers 1 2 4 8 16 32
+"""
+import argparse
+import asyncio
+import json
+import logging
+from time import perf_counter
+
+from test_runner_service import TestRunnerService, Credentials, TestInput, Judge, Concurrency
+from test_runner_service.providers.provider import Provider
+from test_runner_service.providers.provider_factory import ProviderFactory
+from test_runner_service.utils import logger
+from grafite.validators.llmjudge.templates import t1
+
+
+class SleepProvider(Provider):
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def achat(self, model_id, messages, parameters, tools=None):
+        await asyncio.sleep(self.latency)
+        return {"role": "assistant", "content": json.dumps({"score": 1, "justification": "ok"})}
+
+    async def acompletions(self, model_id, prompt, parameters):
+        await asyncio.sleep(self.latency)
+        return "ok"
+
+
+def build_tests(n: int) -> list[TestInput]:
+    return [
+        TestInput(
+            test_id=str(i),
+            messages=[{"role": "user", "content": f"Question {i}"}],
+            judge_template=t1(),
+            ground_truth="ok"
+        ) for i in range(n)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tests", type=int, default=200)
+    parser.add_argument("--judges", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per model call")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 128, 512])
+
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    ProviderFactory.create = staticmethod(lambda source, credentials: SleepProvider(args.latency))
+
+    tests = build_tests(args.tests)
+
+    print(f"{'workers':>8} {'seconds':>10} {'tests/s':>10} {'speedup':>8}")
+
+    baseline = None
+    for workers in args.workers:
+        judges = [Judge(source="ollama", model_id=f"judge-{i}", max_concurrency=workers) for i in range(args.judges)]
+
+        runner = TestRunnerService(
+            source="ollama",
+            model_id="benchmark",
+            credentials=Credentials(),
+            tests=tests,
+            judges=judges,
+            concurrency=Concurrency(generation=workers, judging=workers)
+        )
+
+        start = perf_counter()
+        runner.run()
+        elapsed = perf_counter() - start
+
+        baseline = baseline or elapsed
+        print(f"{workers:>8} {elapsed:>10.2f} {args.tests / elapsed:>10.1f} {baseline / elapsed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
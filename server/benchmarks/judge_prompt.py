@@ -0,0 +1,89 @@
+"""
+Time to render the judge prompts of a run, with the compiled templates of 'get_judge_prompt'
+against the previous implementation (a 'str.replace' pass over the template per result field).
+
+Usage:
+    python benchmarks/judge_prompt.py --results 10000 --judges 3
+"""
+import argparse
+from time import perf_counter
+
+from test_runner_service import TestResult
+from test_runner_service.utils import get_judge_prompt
+from grafite.validators.llmjudge.templates import t1
+
+
+def legacy_get_judge_prompt(result: TestResult) -> str:
+    judge_prompt = str(result.judge_prompt)
+
+    result_as_dict = result.model_dump()
+    for td_k, td_v in result_as_dict.items():
+        inp_key = "{{" + td_k + "}}"
+        if inp_key in judge_prompt:
+            if td_k == 'prompt_text' and not result.prompt_text:
+                continue
+
+            judge_prompt = judge_prompt.replace(inp_key, str(td_v))
+        if td_k == 'messages' and not result.prompt_text:
+            prompt_from_messages = "\n".join(
+                f"{m['role']}: {m['content']}" for m in result.messages
+            )
+
+            judge_prompt = judge_prompt.replace('{{prompt_text}}', prompt_from_messages)
+
+    return judge_prompt
+
+
+def build_results(n: int) -> list[TestResult]:
+    template = t1()
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant. " * 20},
+        {"role": "user", "content": "Summarize the following document. " * 50},
+    ]
+
+    return [
+        TestResult(
+            test_id=str(i),
+            judge_prompt=template,
+            judge_guidelines="The answer must be factual and concise.",
+            messages=messages,
+            ground_truth=f"Expected answer {i}. " * 20,
+            model_response=f"Model answer {i}. " * 40,
+            judge_results=[]
+        ) for i in range(n)
+    ]
+
+
+def measure(render, results: list[TestResult], judges: int) -> float:
+    start = perf_counter()
+
+    for result in results:
+        for _ in range(judges):
+            render(result)
+
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--results", type=int, default=10000)
+    parser.add_argument("--judges", type=int, default=3)
+
+    args = parser.parse_args()
+
+    sample = build_results(1)[0]
+    assert get_judge_prompt(sample) == legacy_get_judge_prompt(sample), "The compiled template renders a different prompt"
+
+    # Fresh results for each implementation, so the compiled version does not start with cached transcripts
+    legacy = measure(legacy_get_judge_prompt, build_results(args.results), args.judges)
+    compiled = measure(get_judge_prompt, build_results(args.results), args.judges)
+
+    prompts = args.results * args.judges
+    print(f"{'implementation':>15} {'seconds':>9} {'us/prompt':>10}")
+    print(f"{'legacy':>15} {legacy:>9.3f} {legacy / prompts * 1e6:>10.1f}")
+    print(f"{'compiled':>15} {compiled:>9.3f} {compiled / prompts * 1e6:>10.1f}")
+    print(f"speedup: {legacy / compiled:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
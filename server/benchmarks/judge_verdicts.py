@@ -0,0 +1,144 @@
+"""
+Checks the verdicts found in judge outputs, whole and streamed, then times 'post_process_judge_response'
+against the previous implementation (a nested-alternation regex over the output) on regular and malformed outputs.
+
+Usage:
+    python benchmarks/judge_verdicts.py --length 2000 --repeat 100
+"""
+import argparse
+import json
+import re
+from time import perf_counter
+
+from test_runner_service.schemas import JudgeResponse
+from test_runner_service.utils import post_process_judge_response, VerdictScanner
+
+VERDICT = '{"justification": "The response matches the ground truth.", "score": 1}'
+
+# Judge outputs and the score of the verdict they hold, None when they hold none
+CASES = [
+    (VERDICT, 1),
+    ('```json\n{"justification": "Braces {} in a string", "score": 0}\n```', 0),
+    ('Here is my verdict: ' + VERDICT + ' Hope this helps.', 1),
+    ('{"verdict": ' + VERDICT + '}', 1),
+    ('Some {prose} in braces, then ' + VERDICT, 1),
+    ('{ a stray brace around ' + VERDICT + ' }', 1),
+    ('Unbalanced { braces { before ' + VERDICT, 1),
+    # Quotes only start strings inside an object, so a stray brace in quoted prose does not hide the verdict
+    ('the "quoted {" text ... ' + VERDICT, 1),
+    ('A quote " and a brace } in the prose, then ' + VERDICT, 1),
+    ('{"justification": "An escaped \\" quote and a } brace", "score": 1}', 1),
+    ('No verdict {"score": 1} here', None),
+    ('No JSON at all', None),
+]
+
+
+def legacy_extract_json_object(input_string):
+    if "```" in input_string:
+        input_string = re.sub(r"^```(?:json|JSON)?\s*\n?", "", input_string, flags=re.MULTILINE)
+        input_string = re.sub(r"\n?```\s*$", "", input_string, flags=re.MULTILINE)
+        input_string = input_string.strip()
+
+    try:
+        parsed = json.loads(input_string)
+        if "justification" in parsed and "score" in parsed:
+            return input_string
+    except json.JSONDecodeError:
+        pass
+
+    pattern = r'\{(?:[^{}]|(?:\{[^{}]*\}))*"justification"\s*:\s*"(?:[^"\\]|\\.)*"\s*,\s*"score"\s*:\s*\d+(?:[^{}]|(?:\{[^{}]*\}))*\}'
+
+    matches = re.findall(pattern, input_string, re.DOTALL | re.IGNORECASE)
+
+    if matches:
+        for match in matches:
+            try:
+                parsed = json.loads(match)
+                if "justification" in parsed and "score" in parsed:
+                    return match
+            except json.JSONDecodeError:
+                continue
+
+    return input_string
+
+
+def legacy_post_process_judge_response(resp_str: str, model_id: str):
+    resp_dict_str = legacy_extract_json_object(resp_str.strip())
+
+    try:
+        resp_dict = json.loads(resp_dict_str.strip())
+        score = resp_dict["score"]
+        justification = resp_dict["justification"]
+    except Exception as e:
+        score = 0
+        justification = (
+            f'Parsing error in the judge response string "{resp_str}".\nError "{e}"'
+        )
+
+    return JudgeResponse(test_score=score, test_justification=justification, model_id=model_id)
+
+
+def stream(text: str, chunk_size: int = 4) -> dict | None:
+    scanner = VerdictScanner()
+
+    for i in range(0, len(text), chunk_size):
+        if scanner.feed(text[i:i + chunk_size]) is not None:
+            break
+
+    return scanner.verdict
+
+
+def check():
+    for text, score in CASES:
+        verdict = post_process_judge_response(text, "judge")
+
+        if score is None:
+            assert verdict.parse_error, f"Verdict found in {text!r}"
+        else:
+            assert not verdict.parse_error and verdict.test_score == score, f"Wrong verdict for {text!r}: {verdict}"
+
+        # Streams stop at a complete verdict. Without one, the whole output is parsed once the stream is over
+        streamed = stream(text)
+        assert streamed is None or streamed["score"] == score, f"Wrong streamed verdict for {text!r}: {streamed}"
+
+
+def build_outputs(length: int) -> dict[str, str]:
+    prose = "The answer covers the main points of the ground truth. " * (length // 56 + 1)
+
+    return {
+        'json': VERDICT,
+        'prose': prose[:length] + VERDICT,
+        'stray braces': "{ " * (length // 2) + VERDICT,
+        'unclosed objects': '{"a": [' * (length // 7),
+        'no verdict': '{"justification": "' + "x" * length + '", "score": 1',
+    }
+
+
+def measure(post_process, text: str, repeat: int) -> float:
+    start = perf_counter()
+
+    for _ in range(repeat):
+        post_process(text, "judge")
+
+    return (perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--length", type=int, default=2000, help="Characters of the malformed outputs")
+    parser.add_argument("--repeat", type=int, default=100)
+
+    args = parser.parse_args()
+
+    check()
+
+    print(f"{'output':>17} {'legacy ms':>10} {'scanner ms':>11}")
+
+    for name, text in build_outputs(args.length).items():
+        legacy = measure(legacy_post_process_judge_response, text, args.repeat)
+        scanner = measure(post_process_judge_response, text, args.repeat)
+        print(f"{name:>17} {legacy * 1e3:>10.3f} {scanner * 1e3:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
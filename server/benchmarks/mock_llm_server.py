@@ -0,0 +1,208 @@
+"""
+Local stand-in for an OpenAI-compatible LLM endpoint (the API used by OllamaProvider), for benchmarks.
+
+Serves '/v1/chat/completions' (optionally streamed) and '/v1/completions' with a configurable
+latency distribution, token rate, error and throttling rates. Judge prompts (asking for a
+'justification') get a canned judge JSON verdict, any other prompt gets filler tokens.
+
+Usage:
+    python benchmarks/mock_llm_server.py --port 11435 --latency 0.2 --latency-dist lognormal --token-rate 50
+    OLLAMA_BASE_URL=http://localhost:11435/v1 python src/grafite/services/digit_listener.py
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import dataclass, asdict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockConfig:
+    # Seconds before the first token: 'fixed', 'uniform' (0 to 2x), 'exponential' or 'lognormal', all with this mean
+    latency: float = 0.05
+    latency_dist: str = "fixed"
+    latency_sigma: float = 0.5
+    # Completion tokens per second, added to the latency (0 returns all the tokens at once)
+    token_rate: float = 0
+    completion_tokens: int = 32
+    # Share of requests answered with a 500 and with a 429
+    error_rate: float = 0
+    throttle_rate: float = 0
+    # Share of judge verdicts with a score of 1
+    judge_pass_rate: float = 0.8
+    # Filler tokens generated after the verdict, like judges that keep going after the closing brace
+    judge_trailing_tokens: int = 0
+    seed: int | None = None
+
+
+def sample_latency(config: MockConfig, rng: random.Random) -> float:
+    if config.latency <= 0:
+        return 0
+
+    if config.latency_dist == "uniform":
+        return rng.uniform(0, 2 * config.latency)
+
+    if config.latency_dist == "exponential":
+        return rng.expovariate(1 / config.latency)
+
+    if config.latency_dist == "lognormal":
+        # 'mu' is chosen so the distribution keeps 'latency' as its mean
+        return rng.lognormvariate(math.log(config.latency) - config.latency_sigma ** 2 / 2, config.latency_sigma)
+
+    return config.latency
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(config.seed)
+
+    def get_failure() -> JSONResponse | None:
+        draw = rng.random()
+
+        if draw < config.error_rate:
+            return JSONResponse({"error": {"message": "mock server error", "type": "server_error"}}, status_code=500)
+
+        if draw < config.error_rate + config.throttle_rate:
+            return JSONResponse({"error": {"message": "mock rate limit", "type": "rate_limit"}}, status_code=429, headers={"Retry-After": "1"})
+
+        return None
+
+    def get_content(prompt: str, max_tokens: int | None) -> tuple[str, int]:
+        if "justification" in prompt:
+            verdict = {"justification": "The response matches the ground truth.", "score": int(rng.random() < config.judge_pass_rate)}
+            content = json.dumps(verdict) + " token" * config.judge_trailing_tokens
+            return content, count_tokens(content)
+
+        tokens = min(config.completion_tokens, max_tokens or config.completion_tokens)
+        return " ".join(["token"] * tokens), tokens
+
+    async def wait(completion_tokens: int):
+        delay = sample_latency(config, rng)
+
+        if config.token_rate > 0:
+            delay += completion_tokens / config.token_rate
+
+        await asyncio.sleep(delay)
+
+    def usage(prompt: str, completion_tokens: int) -> dict:
+        prompt_tokens = count_tokens(prompt)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    async def stream_chat(body: dict, prompt: str, content: str, completion_tokens: int):
+        created = int(time.time())
+        words = content.split(" ")
+        # The first chunk comes after the latency, the others at the token rate, one word per chunk
+        await asyncio.sleep(sample_latency(config, rng))
+
+        for i, word in enumerate(words):
+            piece = word + (" " if i + 1 < len(words) else "")
+            chunk = {
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+
+            if config.token_rate > 0:
+                await asyncio.sleep(1 / config.token_rate)
+
+        final = {
+            "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        }
+
+        if (body.get("stream_options") or {}).get("include_usage"):
+            final["usage"] = usage(prompt, completion_tokens)
+
+        yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "benchmark"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+
+        failure = get_failure()
+        if failure is not None:
+            return failure
+
+        prompt = "\n".join(str(m.get("content") or "") for m in body.get("messages", []))
+        content, completion_tokens = get_content(prompt, body.get("max_tokens"))
+
+        if body.get("stream"):
+            return StreamingResponse(stream_chat(body, prompt, content, completion_tokens), media_type="text/event-stream")
+
+        await wait(completion_tokens)
+
+        return {
+            "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": usage(prompt, completion_tokens)
+        }
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        body = await request.json()
+
+        failure = get_failure()
+        if failure is not None:
+            return failure
+
+        prompt = str(body.get("prompt", ""))
+        content, completion_tokens = get_content(prompt, body.get("max_tokens"))
+
+        await wait(completion_tokens)
+
+        return {
+            "id": "cmpl-mock", "object": "text_completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "text": content}],
+            "usage": usage(prompt, completion_tokens)
+        }
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="Mean seconds before the first token")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"], default=defaults.latency_dist)
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma, help="Sigma of the lognormal distribution")
+    parser.add_argument("--token-rate", type=float, default=defaults.token_rate, help="Completion tokens per second (0 for instant)")
+    parser.add_argument("--completion-tokens", type=int, default=defaults.completion_tokens)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="Share of 500 responses")
+    parser.add_argument("--throttle-rate", type=float, default=defaults.throttle_rate, help="Share of 429 responses")
+    parser.add_argument("--judge-pass-rate", type=float, default=defaults.judge_pass_rate)
+    parser.add_argument("--judge-trailing-tokens", type=int, default=defaults.judge_trailing_tokens, help="Tokens generated after the judge verdict")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def get_config(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(**{key: getattr(args, key) for key in asdict(MockConfig())})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    add_arguments(parser)
+
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(get_config(args)), host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+End-to-end throughput of the test runner against the local mock LLM server (benchmarks/mock_llm_server.py).
+
+Each suite size runs in its own process, so the peak RSS is the one of that run only:
+- 'service' drives TestRunnerService directly and discards the results
+- 'listener' goes through process_digit_run, storing the run and its results in MongoDB ('--mongo-uri' or MONGO_URI).
+  The benchmark documents are removed afterwards.
+
+Reports tests/s, p95 generation and judge latency, peak RSS and the MongoDB write operations and bytes.
+'--baseline' compares the throughput with a previous '--json' report and exits with 1 on a regression.
+
+Usage:
+    python benchmarks/runner_e2e.py --tests 100 1000 10000 --concurrency 64 --latency 0.05 --latency-dist lognormal
+    python benchmarks/runner_e2e.py --mode listener --tests 1000 --mongo-uri mongodb://localhost:27017 --json run.json
+    python benchmarks/runner_e2e.py --tests 1000 --baseline run.json --tolerance 0.15
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from time import perf_counter
+
+import bson
+import httpx
+from pymongo import monitoring
+
+from mock_llm_server import add_arguments, get_config
+from concurrency_scaling import build_tests
+from grafite.db.mongodb import Mongo
+from grafite.metrics import MONGO_OPERATION_DURATION
+from grafite.services import digit_listener
+from test_runner_service import TestRunnerService, Credentials, Judge, Concurrency
+from test_runner_service.utils import logger
+
+WRITE_OPERATIONS = {'insert', 'update', 'bulk_write', 'delete'}
+WRITE_COMMANDS = {'insert', 'update', 'delete', 'findAndModify', 'create', 'drop'}
+
+
+class WriteVolume(monitoring.CommandListener):
+    """Counts the write commands sent to MongoDB and their encoded size"""
+    def __init__(self):
+        self.commands = 0
+        self.bytes = 0
+
+    def started(self, event):
+        if event.command_name in WRITE_COMMANDS:
+            self.commands += 1
+            self.bytes += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def count_write_operations() -> int:
+    """MongoInterface write operations recorded by the Prometheus histogram"""
+    count = 0
+
+    for metric in MONGO_OPERATION_DURATION.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_count') and sample.labels['operation'] in WRITE_OPERATIONS:
+                count += int(sample.value)
+
+    return count
+
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def get_p95(summary: dict | None) -> float | None:
+    if summary is None or summary.get('wall_time') is None:
+        return None
+
+    return summary['wall_time']['p95']
+
+
+def get_judges(args: argparse.Namespace) -> list[Judge]:
+    return [Judge(source="ollama", model_id=f"judge-{i}", max_concurrency=args.concurrency) for i in range(args.judges)]
+
+
+def run_service(args: argparse.Namespace, size: int) -> dict:
+    runner = TestRunnerService(
+        source="ollama",
+        model_id="benchmark",
+        credentials=Credentials(),
+        tests=build_tests(size),
+        judges=get_judges(args),
+        concurrency=Concurrency(generation=args.concurrency, judging=args.concurrency)
+    )
+
+    async def consume() -> int:
+        count = 0
+
+        async for _ in runner.aiter_results():
+            count += 1
+
+        return count
+
+    start = perf_counter()
+    count = asyncio.run(consume())
+    elapsed = perf_counter() - start
+
+    return {'results': count, 'seconds': elapsed, 'metrics': runner.stats()['metrics']}
+
+
+def run_listener(args: argparse.Namespace, size: int) -> dict:
+    suite = build_tests(size)
+    # The run gets the synthetic suite instead of the stored tests
+    digit_listener.get_test_objects = lambda tests, db: suite
+
+    class Channel:
+        class connection:
+            @staticmethod
+            def add_callback_threadsafe(callback):
+                pass
+
+    user = f'benchmark-{uuid.uuid4().hex[:8]}'
+    body = {
+        'user': user,
+        'source': 'ollama',
+        'model': 'benchmark',
+        'judges': [judge.model_dump() for judge in get_judges(args)],
+        'concurrency': {'generation': args.concurrency, 'judging': args.concurrency}
+    }
+
+    start = perf_counter()
+    digit_listener.process_digit_run(Channel, 1, json.dumps(body))
+    elapsed = perf_counter() - start
+
+    db = Mongo()
+    runs = db.run.match({'creator': user})
+
+    try:
+        if len(runs) == 0 or runs[0].get('status') != 'done':
+            raise Exception(f'Benchmark run did not finish: {runs[0] if runs else "no run document"}')
+
+        run = runs[0]
+
+        return {'results': size, 'seconds': elapsed, 'metrics': run.get('metrics')}
+    finally:
+        for run in runs:
+            db.delete_collection(run['run_id'])
+            db.log.collection.delete_many({'item_id': run['run_id']})
+        db.run.collection.delete_many({'creator': user})
+
+
+def run_size(args: argparse.Namespace, size: int) -> dict:
+    write_volume = WriteVolume()
+    monitoring.register(write_volume)
+    writes_before = count_write_operations()
+
+    if args.mode == 'listener':
+        outcome = run_listener(args, size)
+    else:
+        outcome = run_service(args, size)
+
+    metrics = outcome['metrics'] or {}
+
+    return {
+        'mode': args.mode,
+        'tests': size,
+        'results': outcome['results'],
+        'seconds': round(outcome['seconds'], 3),
+        'tests_per_second': round(size / outcome['seconds'], 2),
+        'generation_p95': get_p95(metrics.get('generation')),
+        'judge_p95': max((get_p95(m) or 0 for m in metrics.get('judges', {}).values()), default=None),
+        'judge_early_stops': sum(m.get('early_stops', 0) for m in metrics.get('judges', {}).values()),
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+        'mongo_write_operations': count_write_operations() - writes_before,
+        'mongo_write_commands': write_volume.commands,
+        'mongo_write_bytes': write_volume.bytes
+    }
+
+
+def find_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    config = get_config(args)
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), 'mock_llm_server.py'), '--port', str(port)]
+
+    for key, value in vars(config).items():
+        if value is not None:
+            command += [f'--{key.replace("_", "-")}', str(value)]
+
+    server = subprocess.Popen(command)
+
+    # Wait for the server to accept requests
+    for _ in range(100):
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/v1/models', timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise Exception('The mock LLM server did not start')
+
+
+def compare(reports: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Runs whose throughput dropped by more than 'tolerance' against the baseline run of the same mode and size"""
+    previous = {(r['mode'], r['tests']): r for r in baseline}
+    regressions = []
+
+    for report in reports:
+        base = previous.get((report['mode'], report['tests']))
+
+        if base is not None and report['tests_per_second'] < base['tests_per_second'] * (1 - tolerance):
+            regressions.append(f"{report['mode']} {report['tests']} tests: {report['tests_per_second']} tests/s, baseline {base['tests_per_second']} tests/s")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["service", "listener"], default="service")
+    parser.add_argument("--tests", type=int, nargs="+", default=[100, 1000, 10000], help="Suite sizes, up to 100k")
+    parser.add_argument("--judges", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent generation and judge calls")
+    parser.add_argument("--mongo-uri", type=str, default=None, help="MongoDB of the 'listener' mode, defaults to MONGO_URI")
+    parser.add_argument("--json", type=str, default=None, help="Writes the report to this file")
+    parser.add_argument("--baseline", type=str, default=None, help="Report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed throughput drop against the baseline")
+    # Set by the parent process to run one suite size
+    parser.add_argument("--run-size", type=int, default=None, help=argparse.SUPPRESS)
+    add_arguments(parser)
+
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    # The HTTP client logs every request at the INFO level
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.run_size is not None:
+        print(json.dumps(run_size(args, args.run_size)))
+        return
+
+    port = find_free_port()
+    server = start_mock_server(args, port)
+
+    env = {
+        **os.environ,
+        'OLLAMA_BASE_URL': f'http://127.0.0.1:{port}/v1',
+        # The client-side limiter would cap the runner at its default rate instead of measuring it
+        'OLLAMA_MAX_RPS': '0',
+    }
+
+    if args.mongo_uri is not None:
+        env['MONGO_URI'] = args.mongo_uri
+
+    reports = []
+
+    try:
+        print(f"{'tests':>8} {'seconds':>9} {'tests/s':>9} {'gen p95':>8} {'judge p95':>9} {'rss MB':>8} {'writes':>8} {'MB written':>10}")
+
+        for size in args.tests:
+            output = subprocess.run(
+                [sys.executable, __file__, *sys.argv[1:], '--run-size', str(size)],
+                env=env, check=True, stdout=subprocess.PIPE, text=True
+            ).stdout
+            # The listener prints its progress, the report is the last line
+            report = json.loads(output.strip().splitlines()[-1])
+            reports.append(report)
+
+            print(
+                f"{size:>8} {report['seconds']:>9.2f} {report['tests_per_second']:>9.1f} "
+                f"{report['generation_p95'] or 0:>8.3f} {report['judge_p95'] or 0:>9.3f} {report['peak_rss_mb']:>8.1f} "
+                f"{report['mongo_write_operations']:>8} {report['mongo_write_bytes'] / 1024 / 1024:>10.2f}"
+            )
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(reports, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print(f"Regression: {regression}")
+
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
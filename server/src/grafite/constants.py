@@ -7,5 +7,35 @@ DEFAULT_JUDGE_GUIDELINE = "Model output should be well aligned with the ground t
 WX_API_KEY = os.getenv('WATSONX_API_KEY', '')
 WX_PROJECT_ID = os.getenv('WATSONX_PROJECT_ID', '')
 JUDGE_SYSTEM_PROMPT = os.getenv('JUDGE_SYSTEM_PROMPT', None)
+JUDGE_STRUCTURED_OUTPUT = os.getenv('JUDGE_STRUCTURED_OUTPUT', 'false').lower() == 'true'
+JUDGE_STREAMING = os.getenv('JUDGE_STREAMING', 'true').lower() == 'true'
 OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434/v1')
-DEFAULT_OLLAMA_JUDGE_MODEL = os.getenv('DEFAULT_OLLAMA_JUDGE_MODEL', 'llama3.3')
\ No newline at end of file
+DEFAULT_OLLAMA_JUDGE_MODEL = os.getenv('DEFAULT_OLLAMA_JUDGE_MODEL', 'llama3.3')
+
+# Runs with more than RUN_SHARD_SIZE tests are split into shards of RUN_SHARD_SIZE tests, processed by any listener (0 disables sharding).
+# A failed shard is retried up to SHARD_MAX_ATTEMPTS times before it is marked as failed.
+RUN_SHARD_SIZE = int(os.getenv('RUN_SHARD_SIZE', 0))
+SHARD_MAX_ATTEMPTS = int(os.getenv('SHARD_MAX_ATTEMPTS', 3))
+
+# Messages that fail on a transient error (Mongo, RabbitMQ or a provider being unavailable) are published again after
+# MESSAGE_RETRY_DELAY * 2^(retry - 1) seconds, up to MESSAGE_MAX_ATTEMPTS deliveries. Messages that cannot be processed go to the dead-letter queue.
+MESSAGE_MAX_ATTEMPTS = int(os.getenv('MESSAGE_MAX_ATTEMPTS', 4))
+MESSAGE_RETRY_DELAY = float(os.getenv('MESSAGE_RETRY_DELAY', 30))
+
+# Number of batch runs (or shards) a listener processes at the same time. Also used as the prefetch count of the 'digit_run' queue.
+MAX_CONCURRENT_RUNS = int(os.getenv('MAX_CONCURRENT_RUNS', 2))
+
+# Runs of up to INTERACTIVE_MAX_TESTS selected tests are interactive and go to the 'digit_run.interactive' queue.
+# A listener processes up to INTERACTIVE_CONCURRENT_RUNS of them on top of its batch runs, its prefetch count on that queue.
+INTERACTIVE_MAX_TESTS = int(os.getenv('INTERACTIVE_MAX_TESTS', 50))
+INTERACTIVE_CONCURRENT_RUNS = int(os.getenv('INTERACTIVE_CONCURRENT_RUNS', 1))
+
+# The run events stream polls the run document every RUN_EVENTS_POLL_INTERVAL seconds, and sends a keep-alive comment after RUN_EVENTS_KEEPALIVE seconds without events
+RUN_EVENTS_POLL_INTERVAL = float(os.getenv('RUN_EVENTS_POLL_INTERVAL', 1))
+RUN_EVENTS_KEEPALIVE = float(os.getenv('RUN_EVENTS_KEEPALIVE', 15))
+
+# The listener serves its Prometheus metrics on RUNNER_METRICS_PORT (0 disables it), and polls the depth of its queues every QUEUE_METRICS_INTERVAL seconds
+RUNNER_METRICS_PORT = int(os.getenv('RUNNER_METRICS_PORT', 9100))
+# The API server serves its Prometheus metrics on SERVER_METRICS_PORT (0 disables it), not on its public port
+SERVER_METRICS_PORT = int(os.getenv('SERVER_METRICS_PORT', 9101))
+QUEUE_METRICS_INTERVAL = float(os.getenv('QUEUE_METRICS_INTERVAL', 15))
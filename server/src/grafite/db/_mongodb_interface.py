@@ -3,11 +3,13 @@ import os
 
 # load environment
 from dotenv import load_dotenv, find_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, ReturnDocument
 from pymongo.collection import Collection
 from bson.objectid import ObjectId
 from pydantic import BaseModel
 
+from grafite.metrics import timed_operation
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -42,6 +44,7 @@ class MongoInterface:
         return f(elements)
 
     # # # GET # # # # # # # # # # # # # 
+    @timed_operation('find')
     def get_all(self, projection={}):
         ls = list(self.collection.find(
             filter={}, 
@@ -49,6 +52,7 @@ class MongoInterface:
         )) 
         return self._stringify_objectid(ls)
 
+    @timed_operation('find')
     def get(self, match:dict, fields:dict={}, limit: int | None = None, sort: tuple[str, int] | None = None):
         cursor = self.collection.find(match, fields)
 
@@ -61,6 +65,7 @@ class MongoInterface:
 
         return self._stringify_objectid(list(cursor))   
 
+    @timed_operation('find')
     def get_by_id(self, id: str, id_as_object: bool = True):
         processed_id = ObjectId(id) if id_as_object else id
         
@@ -68,12 +73,14 @@ class MongoInterface:
         return self._stringify_objectid(refs)
 
     # # # MATCH # # # # # # # # # # # # # 
+    @timed_operation('find')
     def match(self, match:dict):
         refs = list(self.collection.find(match))
         return self._stringify_objectid(refs)
     
  
     # # # SAVE # # # # # # # # # # # # # 
+    @timed_operation('insert')
     def save(self, elements: list[dict] | list[BaseModel]):
         logger.info(elements)
         
@@ -84,6 +91,7 @@ class MongoInterface:
         return []
     
     # # # UPDATE # # # # # # # # # # # # # 
+    @timed_operation('update')
     def update(self, filter:dict, element: dict | BaseModel):
         logger.info(filter)
         logger.info(element)
@@ -96,6 +104,20 @@ class MongoInterface:
             update={"$set": element}
         )
 
+    @timed_operation('update')
+    def increment(self, filter: dict, increments: dict, element: dict | None = None):
+        """Atomically increments the 'increments' fields (and sets 'element') of the first match. Returns the updated document"""
+        update = {"$inc": increments}
+
+        if element is not None:
+            update["$set"] = element
+
+        return self._stringify_objectid(self.collection.find_one_and_update(
+            filter=filter,
+            update=update,
+            return_document=ReturnDocument.AFTER
+        ))
+
     def update_by_id(self, id:str, element: dict | BaseModel):        
         if not isinstance(element, dict):
             element = element.model_dump(exclude_defaults=True)
@@ -109,7 +131,21 @@ class MongoInterface:
             return result.inserted_ids
         return ""
 
+    @timed_operation('bulk_write')
+    def bulk_upsert(self, key: str, values: list[dict]):
+        """Inserts or replaces 'values' in a single unordered bulk write, matching documents on 'key'"""
+        if len(values) == 0:
+            return 0
+
+        result = self.collection.bulk_write(
+            [ReplaceOne({key: value[key]}, value, upsert=True) for value in values],
+            ordered=False
+        )
+
+        return result.upserted_count + result.modified_count
+
     # # # DELETE # # # # # # # # # # # # # 
+    @timed_operation('delete')
     def delete_one(self, filter: dict):
         elements = self.match(match=filter)
         
@@ -123,6 +159,7 @@ class MongoInterface:
     def delete_collection(self, collection_name: str):
         return self.db.drop_collection(collection_name)
     
+    @timed_operation('count')
     def count_documents(self, filter: dict = {}) -> int:
         return self.collection.count_documents(filter=filter)
 
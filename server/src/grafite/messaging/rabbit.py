@@ -2,6 +2,7 @@ import dataclasses
 import json
 import os
 import ssl
+import time
 import pika  # type: ignore
 from dotenv import load_dotenv, find_dotenv
 
@@ -9,14 +10,29 @@ load_dotenv(find_dotenv(), override=True)
 
 
 class Rabbit:
-    def __init__(self, queue_name):
+    def __init__(self, queue_name, prefetch_count: int = 1, connection: pika.BlockingConnection | None = None):
         self.rmq_host = os.environ['RABBITMQ_HOST']
         self.rmq_port = int(os.environ['RABBITMQ_PORT'])
         self.rmq_user = os.getenv('RABBITMQ_USER', None)
         self.rmq_pwd = os.getenv('RABBITMQ_PWD', None)
         self.rmq_ca_file = os.getenv('RABBITMQ_CA_FILE', None)
         self.rmq_queue_name = queue_name
+        self.retry_levels = 0
 
+        if connection is not None:
+            # The queues of a listener share its connection, each one on its own channel
+            self.connection = connection
+        else:
+            self.connection = self._connect()
+
+        self.channel = self.connection.channel()
+
+        self.channel.queue_declare(queue=self.rmq_queue_name, durable=True)
+
+        # RabbitMQ stops delivering once 'prefetch_count' messages are unacknowledged
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    def _connect(self) -> pika.BlockingConnection:
         print('Connecting to RabbitMQ instance...')
         print(f'Queue: {self.rmq_queue_name} / TLS enabled: {self.rmq_ca_file is not None}')
 
@@ -28,7 +44,7 @@ class Rabbit:
                 context = ssl.create_default_context()
                 context.load_verify_locations(cafile=self.rmq_ca_file)
 
-                self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+                return pika.BlockingConnection(pika.ConnectionParameters(
                     host=self.rmq_host,
                     port=self.rmq_port,
                     credentials=pika.PlainCredentials(self.rmq_user, self.rmq_pwd),
@@ -36,7 +52,7 @@ class Rabbit:
                     heartbeat=300
                 ))
             elif self.rmq_user is None or self.rmq_pwd is None:
-                self.connection = pika.BlockingConnection(
+                return pika.BlockingConnection(
                     pika.ConnectionParameters(
                         host=self.rmq_host,
                         port=self.rmq_port,
@@ -44,7 +60,7 @@ class Rabbit:
                     )
                 )
             else:
-                self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+                return pika.BlockingConnection(pika.ConnectionParameters(
                     host=self.rmq_host,
                     port=self.rmq_port,
                     credentials=pika.PlainCredentials(self.rmq_user, self.rmq_pwd),
@@ -55,11 +71,62 @@ class Rabbit:
             print(error, flush=True)
             raise Exception("Failed to connect to RabbitMQ service!")
 
-        self.channel = self.connection.channel()
-
-        self.channel.queue_declare(queue=self.rmq_queue_name, durable=True)
+    def declare_retry_queues(self, max_attempts: int, base_delay: float):
+        """
+        Declares the '<queue>.retry' exchange, with one delay queue per retry, and the '<queue>.dead' queue.
+        Messages wait in the delay queue of their retry for 'base_delay * 2^(retry - 1)' seconds, then expire
+        back into the queue. The queue itself keeps its arguments, so publishers can keep declaring it as is.
+        """
+        self.channel.exchange_declare(exchange=self.retry_exchange, exchange_type='direct', durable=True)
+
+        for retry in range(1, max(max_attempts, 1)):
+            delay_queue = f'{self.rmq_queue_name}.retry.{retry}'
+
+            self.channel.queue_declare(queue=delay_queue, durable=True, arguments={
+                'x-message-ttl': int(base_delay * 2 ** (retry - 1) * 1000),
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': self.rmq_queue_name
+            })
+            self.channel.queue_bind(queue=delay_queue, exchange=self.retry_exchange, routing_key=str(retry))
+
+        self.retry_levels = max(max_attempts - 1, 0)
+        self.channel.queue_declare(queue=self.dead_letter_queue, durable=True)
+
+    @property
+    def retry_exchange(self) -> str:
+        return f'{self.rmq_queue_name}.retry'
+
+    @property
+    def dead_letter_queue(self) -> str:
+        return f'{self.rmq_queue_name}.dead'
+
+    def publish_retry(self, body: str | bytes, attempt: int):
+        """Publishes 'body' again after the delay of its 'attempt'-th retry. Its 'x-attempt' header becomes 'attempt + 1'"""
+        # Without delay queues (a single attempt), the message goes straight back to the queue
+        exchange, routing_key = (self.retry_exchange, str(min(attempt, self.retry_levels))) if self.retry_levels > 0 else ('', self.rmq_queue_name)
+
+        self.channel.basic_publish(exchange=exchange,
+                                   routing_key=routing_key,
+                                   body=body,
+                                   properties=pika.BasicProperties(timestamp=int(time.time()), delivery_mode=2, headers={'x-attempt': attempt + 1}))
+
+    def publish_dead_letter(self, body: str | bytes, error: str, attempt: int = 1):
+        """Publishes a message that cannot be processed on the dead-letter queue, with the error that stopped it"""
+        self.channel.basic_publish(exchange='',
+                                   routing_key=self.dead_letter_queue,
+                                   body=body,
+                                   properties=pika.BasicProperties(timestamp=int(time.time()), delivery_mode=2, headers={'x-attempt': attempt, 'x-error': error[:1000]}))
+
+    def get_message_count(self, queue_name: str | None = None) -> int:
+        """Messages ready in 'queue_name', the queue of this connection by default. The queue must exist"""
+        # The broker closes the channel of a passive declare of a missing queue, so it does not run on the consumer channel
+        channel = self.connection.channel()
 
-        self.channel.basic_qos(prefetch_count=1)
+        try:
+            return channel.queue_declare(queue=queue_name or self.rmq_queue_name, passive=True).method.message_count
+        finally:
+            if channel.is_open:
+                channel.close()
 
     def consume_messages(self, message_callback):
         if len(self.rmq_queue_name) == 0:
@@ -72,14 +139,19 @@ class Rabbit:
         if len(self.rmq_queue_name) == 0:
             raise Exception("Queue name not set!")
 
+        # The timestamp lets consumers measure how long the message waited in the queue
+        properties = pika.BasicProperties(timestamp=int(time.time()))
+
         if not as_dict:
             self.channel.basic_publish(exchange='',
                                        routing_key=self.rmq_queue_name,
-                                       body=json.dumps(payload))
+                                       body=json.dumps(payload),
+                                       properties=properties)
         else:
             self.channel.basic_publish(exchange='',
                                        routing_key=self.rmq_queue_name,
-                                       body=json.dumps(dataclasses.asdict(payload)))
+                                       body=json.dumps(dataclasses.asdict(payload)),
+                                       properties=properties)
 
     def start(self):
         self.channel.start_consuming()
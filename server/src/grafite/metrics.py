@@ -0,0 +1,71 @@
+"""
+Prometheus metrics of the API server and the test runner. Collectors live in the default registry of the process,
+served by 'start_metrics_server' on a port of their own, kept off the public API.
+"""
+import functools
+from time import perf_counter
+from typing import Callable, TypeVar
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+T = TypeVar('T')
+
+# Model calls take seconds to minutes, the default buckets stop at 10 seconds
+CALL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# # # HTTP # # # # # # # # # # # # #
+HTTP_REQUESTS = Counter('grafite_http_requests_total', 'HTTP requests', ['method', 'route', 'status'])
+HTTP_REQUEST_DURATION = Histogram('grafite_http_request_duration_seconds', 'HTTP request duration, until the response headers', ['method', 'route'])
+
+# # # MONGODB # # # # # # # # # # # #
+MONGO_OPERATION_DURATION = Histogram('grafite_mongo_operation_duration_seconds', 'MongoInterface operation duration', ['operation', 'collection'])
+MONGO_OPERATION_ERRORS = Counter('grafite_mongo_operation_errors_total', 'Failed MongoInterface operations', ['operation', 'collection'])
+
+# # # PROVIDERS # # # # # # # # # # #
+PROVIDER_CALLS = Counter('grafite_provider_calls_total', 'Provider calls, after retries', ['source', 'model_id', 'outcome'])
+PROVIDER_CALL_DURATION = Histogram('grafite_provider_call_duration_seconds', 'Provider call duration, including retries and rate limiter waits', ['source', 'model_id'], buckets=CALL_BUCKETS)
+PROVIDER_CALLS_IN_FLIGHT = Gauge('grafite_provider_calls_in_flight', 'Provider calls in progress', ['source', 'model_id'])
+PROVIDER_RETRIES = Counter('grafite_provider_retries_total', 'Retried provider call attempts', ['source', 'model_id'])
+PROVIDER_TOKENS = Counter('grafite_provider_tokens_total', 'Tokens reported by the provider responses', ['source', 'model_id', 'type'])
+JUDGE_VERDICTS = Counter('grafite_judge_verdicts_total', 'Judge outputs by parse outcome (parsed, parse_error)', ['model_id', 'outcome'])
+JUDGE_EARLY_STOPS = Counter('grafite_judge_early_stops_total', 'Judge streams closed once their verdict was complete', ['model_id'])
+
+# # # CACHES # # # # # # # # # # # # #
+CACHE_REQUESTS = Counter('grafite_cache_requests_total', 'Response cache lookups', ['cache', 'result'])
+
+# # # RABBITMQ # # # # # # # # # # # #
+RABBITMQ_MESSAGES = Counter('grafite_rabbitmq_messages_total', 'Consumed messages by outcome (acked, retried, dead_lettered)', ['queue', 'outcome'])
+RABBITMQ_QUEUE_MESSAGES = Gauge('grafite_rabbitmq_queue_messages', 'Messages ready in a queue, polled by the listener', ['queue'])
+RABBITMQ_QUEUE_WAIT = Histogram('grafite_rabbitmq_queue_wait_seconds', 'Time between the publish of a message and the start of its run', ['queue'], buckets=CALL_BUCKETS)
+RUNS_IN_PROGRESS = Gauge('grafite_runs_in_progress', 'Runs (or shards) being processed by the listener', ['priority'])
+RUNS_PENDING = Gauge('grafite_runs_pending', 'Delivered runs waiting for a slot in the listener scheduler', ['priority'])
+
+def get_collection_label(name: str) -> str:
+    # Each run stores its results in its own collection, which would make a label value per run
+    return 'run_results' if name.startswith('run_') else name
+
+def timed_operation(operation: str):
+    """Records the duration and failures of a 'MongoInterface' method"""
+    def decorator(method: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            collection = get_collection_label(self.collection.name) if self.collection is not None else ''
+            start = perf_counter()
+
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                MONGO_OPERATION_ERRORS.labels(operation, collection).inc()
+                raise
+            finally:
+                MONGO_OPERATION_DURATION.labels(operation, collection).observe(perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+def start_metrics_server(port: int):
+    """Serves the metrics on 'port' from a daemon thread. 0 disables it"""
+    if port > 0:
+        start_http_server(port)
+        print(f'Serving metrics on port {port}')
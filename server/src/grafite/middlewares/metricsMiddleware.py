@@ -0,0 +1,24 @@
+from time import perf_counter
+
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from grafite.metrics import HTTP_REQUESTS, HTTP_REQUEST_DURATION
+
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+
+    async def dispatch(self, request, call_next):
+        start = perf_counter()
+        status = 500
+
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # Routes are labelled by their template, so '/run/{run_id}' is a single series
+            route = request.scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+
+            HTTP_REQUESTS.labels(request.method, path, str(status)).inc()
+            HTTP_REQUEST_DURATION.labels(request.method, path).observe(perf_counter() - start)
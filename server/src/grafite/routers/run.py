@@ -1,6 +1,12 @@
+import asyncio
+import json
+from time import monotonic
+from datetime import datetime, timezone
 from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from starlette.requests import Request
 from grafite.db.mongodb import Mongo
+from grafite.constants import RUN_EVENTS_POLL_INTERVAL, RUN_EVENTS_KEEPALIVE
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -8,6 +14,9 @@ load_dotenv()
 router = APIRouter()
 db = Mongo()
 
+FINISHED_RUN_STATUSES = ["done", "failed", "cancelled"]
+RUN_EVENT_FIELDS = {"_id": False, "run_id": True, "status": True, "progress": True, "error_msg": True, "cancel_requested": True, "shards": True}
+
 
 @router.get("/run")
 async def get_all_runs(request: Request):
@@ -35,6 +44,72 @@ async def get_run(request: Request, run_id: str):
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
     
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@router.get("/run/{run_id}/events")
+async def get_run_events(request: Request, run_id: str):
+    """
+    Server-sent events with the status and progress of a run: a 'progress' event whenever they change,
+    then an 'end' event once the run is finished.
+    """
+    runs = await asyncio.to_thread(db.run.get, {"run_id": run_id}, RUN_EVENT_FIELDS)
+
+    if len(runs) == 0:
+        raise HTTPException(status_code=404, detail='Run not found')
+
+    async def events():
+        run, last_event, last_sent = runs[0], None, monotonic()
+
+        while not await request.is_disconnected():
+            if run != last_event:
+                yield format_event("progress", run)
+                last_event, last_sent = run, monotonic()
+            elif monotonic() - last_sent >= RUN_EVENTS_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                last_sent = monotonic()
+
+            if run.get("status") in FINISHED_RUN_STATUSES:
+                yield format_event("end", run)
+                return
+
+            await asyncio.sleep(RUN_EVENTS_POLL_INTERVAL)
+
+            matches = await asyncio.to_thread(db.run.get, {"run_id": run_id}, RUN_EVENT_FIELDS)
+
+            if len(matches) == 0:
+                yield format_event("end", {**run, "status": "deleted"})
+                return
+
+            run = matches[0]
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.post("/run/{run_id}/cancel")
+async def cancel_run(request: Request, run_id: str):
+    """Asks the listener processing the run to stop starting new tests. The child runs of a comparison run are cancelled too"""
+    try:
+        runs = db.run.match({"run_id": run_id})
+
+        if len(runs) == 0:
+            raise HTTPException(status_code=404, detail='Run not found')
+
+        run = runs[0]
+
+        if run.get("status") in FINISHED_RUN_STATUSES:
+            raise HTTPException(status_code=409, detail=f"Run is already {run['status']}")
+
+        cancel_requested_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+        for id in [run_id, *run.get("child_run_ids", [])]:
+            db.run.update(filter={"run_id": id}, element={"cancel_requested": True, "cancel_requested_at": cancel_requested_at})
+
+        return Response(status_code=202, content=run_id)
+    except HTTPException as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.delete('/run/{run_id}')
 async def delete_report(request: Request, run_id: str):
     try:
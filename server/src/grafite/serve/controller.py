@@ -9,6 +9,7 @@ from starlette.requests import Request
 
 from fastapi.middleware.cors import CORSMiddleware
 from grafite.middlewares.loggerMiddleware import LoggerMiddleware
+from grafite.middlewares.metricsMiddleware import MetricsMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from bson.objectid import ObjectId
 
@@ -22,6 +23,8 @@ from grafite.routers import (
     log
 )
 from grafite.db.mongodb import Mongo
+from grafite.constants import SERVER_METRICS_PORT
+from grafite.metrics import start_metrics_server
 
 db = Mongo()
 
@@ -64,6 +67,8 @@ def seed_db():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     seed_db()
+    # The metrics are served on an internal port, so they are not reachable through the public API
+    start_metrics_server(SERVER_METRICS_PORT)
     yield
 
 app = FastAPI(lifespan=lifespan)
@@ -75,6 +80,8 @@ app.add_middleware(CORSMiddleware,
                    allow_headers=["*"]
                    )
 app.add_middleware(LoggerMiddleware, db=db)
+# Added last so it is the outermost middleware and times the whole stack
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get('/')
@@ -1,4 +1,5 @@
 import sys
+import asyncio
 import threading
 import json
 import os
@@ -7,29 +8,143 @@ from datetime import datetime, timezone
 from grafite.messaging.rabbit import Rabbit
 import functools
 from dotenv import load_dotenv
-from test_runner_service import TestRunnerService, Credentials, TestInput, Judge, Parameters
+from pika.exceptions import AMQPConnectionError, AMQPChannelError
+from pymongo.errors import ConnectionFailure
+from test_runner_service import TestRunnerService, ComparisonRunnerService, Credentials, TestInput, TestResult, Judge, Parameters, Concurrency, Candidate
+from test_runner_service.event_loop import run_coroutine
 from test_runner_service.test_runner_wrapper import TestRunnerWrapper
+from test_runner_service.cache import ResponseCache, MongoCacheStore, DiskCacheStore
+from test_runner_service.utils import summarize_results, summarize_metrics, get_run_id
+from test_runner_service.constants import CACHE_STORE, CACHE_DIR, CACHE_MAX_ENTRIES, CACHE_TTL
+from test_runner_service.providers.retry import CircuitOpenError, RetriesExceededError, is_retryable_error, get_circuit_breaker
 from grafite.db.mongodb import Mongo
+from grafite.services.run_scheduler import RunScheduler, RunPriority
 from grafite.schemas.log import Log
-from grafite.constants import WX_API_KEY, WX_PROJECT_ID, DEFAULT_OLLAMA_JUDGE_MODEL
+from grafite.constants import WX_API_KEY, WX_PROJECT_ID, DEFAULT_OLLAMA_JUDGE_MODEL, RUN_SHARD_SIZE, SHARD_MAX_ATTEMPTS, MAX_CONCURRENT_RUNS
+from grafite.constants import INTERACTIVE_MAX_TESTS, INTERACTIVE_CONCURRENT_RUNS, MESSAGE_MAX_ATTEMPTS, MESSAGE_RETRY_DELAY
+from grafite.constants import RUNNER_METRICS_PORT, QUEUE_METRICS_INTERVAL
+from grafite.metrics import RABBITMQ_MESSAGES, RABBITMQ_QUEUE_MESSAGES, RABBITMQ_QUEUE_WAIT, RUNS_IN_PROGRESS, RUNS_PENDING, start_metrics_server
 
 try:
     from rich import print
 except:
     pass
 
+class RetryMessageError(Exception):
+    """Raised while processing a message to publish 'body', instead of the original message, on the retry exchange"""
+
+    def __init__(self, body: str, error: Exception):
+        super().__init__(str(error))
+        self.body = body
+
+class RunFailedError(Exception):
+    """Raised once a run is recorded as failed, so its message goes to the dead-letter queue instead of being acknowledged"""
+
+    def __init__(self, error: Exception):
+        super().__init__(str(error))
+
+def is_transient_error(error: Exception) -> bool:
+    """Errors of the infrastructure (Mongo, RabbitMQ, a provider endpoint), which a later delivery may not hit"""
+    if isinstance(error, (RetryMessageError, ConnectionFailure, AMQPConnectionError, AMQPChannelError, CircuitOpenError, RetriesExceededError)):
+        return True
+
+    return is_retryable_error(error)
+
+def should_retry_message(error: Exception, attempt: int) -> bool:
+    return is_transient_error(error) and attempt < MESSAGE_MAX_ATTEMPTS
+
+caches: dict[str, ResponseCache] = {}
+caches_lock = threading.Lock()
+
+def get_cache(name: str, db: Mongo) -> ResponseCache:
+    """Returns the process-wide cache 'name', shared by all the runs handled by this listener."""
+    with caches_lock:
+        if name not in caches:
+            store = None
+
+            if CACHE_STORE == 'mongo':
+                store = MongoCacheStore(db._get_interface_instance(name).collection)
+            elif CACHE_STORE == 'disk':
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                store = DiskCacheStore(os.path.join(CACHE_DIR, f'{name}.sqlite'), max_entries=CACHE_MAX_ENTRIES)
+
+            caches[name] = ResponseCache(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, store=store, name=name)
+
+        return caches[name]
+
+def get_run_priority(job_parameters: dict) -> RunPriority:
+    """
+    Priority of a 'digit_run' message, deciding the queue it is published on. Runs can set their 'priority'.
+    Otherwise runs of up to INTERACTIVE_MAX_TESTS selected tests are interactive
+    """
+    if job_parameters.get("priority") in ("interactive", "batch"):
+        return job_parameters["priority"]
+
+    if job_parameters.get("type") == "shard":
+        return "batch"
+
+    tests = job_parameters.get("tests", "*")
+
+    if isinstance(tests, list) and len(tests) <= INTERACTIVE_MAX_TESTS:
+        return "interactive"
+
+    return "batch"
+
+# Interactive runs have their own queue, so they are not delivered behind the backlog of batch runs
+RUN_QUEUES: dict[RunPriority, str] = {"batch": "digit_run", "interactive": "digit_run.interactive"}
+
+def get_queued_at(properties) -> datetime:
+    """Publish time of a message, when the publisher sets it, or else the delivery time"""
+    timestamp = getattr(properties, "timestamp", None)
+
+    if timestamp:
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+
+    return datetime.now(timezone.utc)
+
+def get_attempt(properties) -> int:
+    """Delivery attempt of a message, counted in its 'x-attempt' header by the retry exchange"""
+    headers = getattr(properties, "headers", None) or {}
+
+    return int(headers.get("x-attempt", 1))
+
+def run_message(callback, rabbit_mq: Rabbit, priority: RunPriority, ch, delivery_tag, body, queued_at: datetime, attempt: int = 1):
+    try:
+        callback(ch, delivery_tag, body, queued_at=queued_at, attempt=attempt, priority=priority)
+    except Exception as error:
+        # Runs acknowledge their message when they finish, a message left unacknowledged would hold an executor forever.
+        # Instead of sleeping here, transient failures go through a delay queue and come back to any listener.
+        if should_retry_message(error, attempt):
+            print(f'WARNING Run processing failed (attempt {attempt}/{MESSAGE_MAX_ATTEMPTS}), retrying later: {error}')
+            publish = functools.partial(rabbit_mq.publish_retry, error.body if isinstance(error, RetryMessageError) else body, attempt)
+            RABBITMQ_MESSAGES.labels(rabbit_mq.rmq_queue_name, 'retried').inc()
+        else:
+            print(f'ERROR Run processing failed, moving the message to {rabbit_mq.dead_letter_queue}: {error}')
+            publish = functools.partial(rabbit_mq.publish_dead_letter, body, str(error), attempt)
+            RABBITMQ_MESSAGES.labels(rabbit_mq.rmq_queue_name, 'dead_lettered').inc()
+
+        ch.connection.add_callback_threadsafe(functools.partial(republish_message, ch, delivery_tag, publish))
+
+def republish_message(ch, delivery_tag, publish):
+    """Publishes the new copy of a message, then acknowledges the original, so it is not lost in between"""
+    if ch.is_open:
+        publish()
+        ch.basic_ack(delivery_tag)
+    else:
+        print('ERROR Channel Closed when trying to republish, the message will be redelivered')
+
 def process_message(ch, method, properties, body, args):
-    callback = args
+    callback, scheduler, rabbit_mq, priority = args
 
     delivery_tag = method.delivery_tag
 
-    t = threading.Thread(
-        target=callback, args=(ch, delivery_tag, body)
+    # The priority of a run is the one of the queue it was delivered from
+    print(f'Scheduling {priority} run...')
+    scheduler.submit(
+        priority=priority,
+        task=functools.partial(run_message, callback, rabbit_mq, priority, ch, delivery_tag, body, get_queued_at(properties), get_attempt(properties))
     )
 
-    print('Starting digit listener thread...')
-    t.start()
-
 
 def ack_message(ch, delivery_tag):
     if ch.is_open:
@@ -82,39 +197,515 @@ def get_test_objects(tests: Union[str, list], db:Mongo ):
     
     
     
-def process_digit_run(channel, delivery_tag, body):
-    print(f'Test Runner: processing run: {body}')
-    db = Mongo()
+def get_judges(job_parameters: dict) -> list[Judge]:
+    judges = [
+        Judge(**judge) if isinstance(judge, dict) else Judge(source="ollama", model_id=judge) 
+        for judge in job_parameters.get("judges", [])
+    ]
 
-    job_parameters:dict = json.loads(body)
-    
-    print("job_parameters", job_parameters)
+    if len(judges) == 0:
+        judges = [Judge(source='ollama', model_id=DEFAULT_OLLAMA_JUDGE_MODEL)]
 
-    wrapper = None
+    return judges
 
-    judges = [Judge(source="ollama", model_id=judge) for judge in job_parameters.get("judges", [])]
+def get_credentials(job_parameters: dict) -> Credentials:
+    return Credentials(
+        watsonx_api_key=job_parameters.get('WX_API_KEY', WX_API_KEY), 
+        watsonx_project_id=job_parameters.get('WX_PROJECT_ID', WX_PROJECT_ID), 
+    )
 
-    if len(judges) == 0:
-        judges = [Judge(source='ollama', model_id=DEFAULT_OLLAMA_JUDGE_MODEL)]
+# Fields of a 'digit_run' message saved in the 'options' of its run, so a resumed run keeps them
+RUN_OPTIONS = ("concurrency", "response_cache", "judge_cache")
+
+def get_run_options(job_parameters: dict) -> dict:
+    return {key: job_parameters[key] for key in RUN_OPTIONS if key in job_parameters}
+
+def get_resumed_job_parameters(run: dict) -> dict:
+    """Rebuilds the 'digit_run' message of an existing run"""
+    return {
+        "user": run.get("creator", ''),
+        "model": run.get("model_id", ''),
+        "source": run.get("source", 'ollama'),
+        "tests": run.get("tests", "*"),
+        "params": run.get("config", {}),
+        "judges": run.get("judges", run.get("judge_model_ids", [])),
+        **({"priority": run["priority"]} if run.get("priority") is not None else {}),
+        **run.get("options", {}),
+        **({"candidates": run.get("candidates", [])} if run.get("type") == "comparison" else {}),
+    }
+
+def get_stored_results(run_id: str, db: Mongo, judges: list[Judge], test_ids: list[str] | None = None) -> tuple[set[str], list[TestResult], dict[str, list[dict]]]:
+    """
+    Splits the results already stored for 'run_id' into the ids of finished tests
+    and the results whose generation succeeded but judging failed, with the human annotations
+    of the latter by test id, so they are saved again with the new verdicts.
+    Results whose generation failed are left out, so their tests run again.
+    'test_ids' restricts the lookup to the tests of a shard.
+    """
+    finished: set[str] = set()
+    to_judge: list[TestResult] = []
+    human_judge_results: dict[str, list[dict]] = {}
+
+    results_db = db._get_interface_instance(run_id)
+    results = results_db.get_all() if test_ids is None else results_db.get(match={"test_id": {"$in": test_ids}})
+
+    for result in results:
+        if result.get('error'):
+            continue
+
+        judge_results = [j for j in result.get('judge_results') or [] if j.get('type') != 'human']
+
+        if len(judge_results) >= len(judges) and not any(j.get('error') for j in judge_results):
+            finished.add(result['test_id'])
+        else:
+            to_judge.append(TestResult(**{**result, "judge_results": []}))
+            human_judge_results[result['test_id']] = [j for j in result.get('judge_results') or [] if j.get('type') == 'human']
+
+    return finished, to_judge, human_judge_results
+
+def process_comparison_run(job_parameters: dict, db: Mongo, queue_wait_time: float | None = None, attempt: int = 1):
+    """
+    Runs the tests against every model of 'candidates'. Each candidate gets its own child run,
+    and the parent run document holds the side-by-side summary.
+    A 'resume_run_id' resumes the comparison and all its child runs, keeping their ids and results.
+    """
+    wrappers: list[TestRunnerWrapper] = []
+    # Set once the run documents exist, so a retry can resume them
+    run_id = None
+
+    try:
+        resume_run_id = job_parameters.get("resume_run_id")
+        run = None
+
+        if resume_run_id is not None:
+            runs = db.run.match({"run_id": resume_run_id})
+
+            if len(runs) == 0:
+                raise Exception(f"Run '{resume_run_id}' not found")
+
+            run = runs[0]
+            run_id = resume_run_id
+
+            # A comparison cancelled while it was waiting for a retry is not resumed
+            if run.get("cancel_requested") and run.get("status") == "retrying":
+                db.run.update(filter={"run_id": resume_run_id}, element={"status": "cancelled"})
+                return
+
+            job_parameters = {**get_resumed_job_parameters(run), **job_parameters}
+
+        candidates = [Candidate(**candidate) for candidate in job_parameters["candidates"]]
+        judges = get_judges(job_parameters)
+        concurrency: Concurrency = Concurrency(**job_parameters.get("concurrency", {}))
+
+        # The tests are loaded once for all the candidates
+        tests = job_parameters.get('tests',"*")
+        test_list = get_test_objects(tests=tests, db=db)
+        number_of_tests = len(test_list)
+
+        now = datetime.now(timezone.utc)
+        parent_run_id = resume_run_id or get_run_id(now)
+        child_run_ids = run["child_run_ids"] if run is not None else [f'{parent_run_id}_{i + 1}' for i in range(len(candidates))]
+
+        # Finished tests, results to judge again and their human annotations, per candidate
+        stored = [
+            get_stored_results(child_run_id, db=db, judges=judges) if run is not None else (set(), [], {})
+            for child_run_id in child_run_ids
+        ]
+
+        comparison = ComparisonRunnerService(
+            candidates=candidates,
+            credentials=get_credentials(job_parameters),
+            tests=test_list,
+            judges=judges,
+            concurrency=concurrency,
+            response_cache=get_cache('response_cache', db) if job_parameters.get('response_cache', False) else None,
+            verdict_cache=get_cache('judge_cache', db) if job_parameters.get('judge_cache', False) else None,
+            candidate_tests=[
+                [t for t in test_list if t.test_id not in done]
+                for done in (finished | {r.test_id for r in to_judge} for finished, to_judge, _ in stored)
+            ],
+            results_to_judge=[to_judge for _, to_judge, _ in stored]
+        )
+
+        wrappers = [
+            TestRunnerWrapper(
+                creator=job_parameters.get("user", ''),
+                test_runner=runner,
+                db=db,
+                tests=tests,
+                number_of_tests=number_of_tests,
+                run_params=candidate.parameters.model_dump(),
+                run_id=child_run_id,
+                completed_results=len(finished),
+                human_judge_results=human_judge_results
+            )
+            for candidate, runner, child_run_id, (finished, _, human_judge_results) in zip(candidates, comparison.runners, child_run_ids, stored)
+        ]
+
+        log = Log(
+            item_id=parent_run_id,
+            method='PATCH' if run is not None else 'POST',
+            payload=job_parameters,
+            table='run',
+            target_url='digit_run',
+            timestamp=now.strftime('%Y-%m-%d %H:%M:%S'),
+            user=job_parameters.get('user','')
+        )
+        db.log.save([log])
+
+        if run is None:
+            db.run.save([{
+                "run_id": parent_run_id,
+                "type": "comparison",
+                "creator": job_parameters.get("user", ''),
+                "tests": tests,
+                "candidates": [c.model_dump() for c in candidates],
+                "judge_model_ids": [j.model_id for j in judges],
+                "judges": [j.model_dump() for j in judges],
+                "number_of_tests": number_of_tests,
+                "created_at": now.strftime('%Y-%m-%d %H:%M'),
+                "child_run_ids": child_run_ids,
+                "priority": get_run_priority(job_parameters),
+                "options": get_run_options(job_parameters),
+                "queue_wait_time": queue_wait_time,
+                "status": "in progress"
+            }])
+
+            db.run.save([{**w.get_details(), "parent_run_id": parent_run_id, "status": "in progress"} for w in wrappers])
+        else:
+            db.run.update(
+                filter={"run_id": parent_run_id},
+                element={
+                    "status": "in progress",
+                    "error_msg": None,
+                    "cancel_requested": False,
+                    "resumed_at": now.strftime('%Y-%m-%d %H:%M'),
+                    "resume_count": run.get("resume_count", 0) + 1,
+                    "queue_wait_time": queue_wait_time,
+                    "number_of_tests": number_of_tests,
+                    "options": get_run_options(job_parameters)
+                }
+            )
+
+            for wrapper in wrappers:
+                db.run.update(
+                    filter={"run_id": wrapper.run_id},
+                    element={"status": "in progress", "error_msg": None, "cancel_requested": False, "number_of_tests": number_of_tests, "progress": wrapper.get_progress()}
+                )
+
+        run_id = parent_run_id
+
+        try:
+            async def execute_all():
+                # 'return_exceptions' lets the other candidates finish when one of them fails
+                return await asyncio.gather(*[w.aexecute_tests() for w in wrappers], return_exceptions=True)
+
+            errors = run_coroutine(execute_all())
+        except Exception as error:
+            errors = [error] * len(wrappers)
+
+        END_TIME = datetime.now(timezone.utc)
+        elapsed_time = f'{(END_TIME - now).total_seconds()} seconds'
+
+        for wrapper, error in zip(wrappers, errors):
+            if isinstance(error, Exception):
+                db.run.update(filter={"run_id": wrapper.run_id}, element={"status": "failed", "error_msg": str(error)})
+                wrapper.load_to_db(results=[])
+            else:
+                db.run.update(
+                    filter={"run_id": wrapper.run_id},
+                    element={"status": "cancelled" if wrapper.cancelled else "done", "elapsed_time": elapsed_time, **wrapper.get_stats()}
+                )
+
+        # The summary is built from the stored results, so it also covers results saved before a failure
+        results = [
+            [TestResult(**r) for r in db._get_interface_instance(wrapper.run_id).get_all()]
+            for wrapper in wrappers
+        ]
+        failed = [str(e) for e in errors if isinstance(e, Exception)]
+        status = "done"
+
+        if len(failed) > 0:
+            status = "failed"
+        elif any(w.cancelled for w in wrappers):
+            status = "cancelled"
+
+        db.run.update(
+            filter={"run_id": run_id},
+            element={
+                "status": status,
+                "error_msg": "\n".join(failed) if len(failed) > 0 else None,
+                "elapsed_time": elapsed_time,
+                "summary": ComparisonRunnerService.summarize(candidates, results)
+            }
+        )
+    except Exception as error:
+        # Before the run documents exist, the message itself is retried or dead-lettered
+        if run_id is None:
+            raise
+
+        print(error)
+
+        for wrapper in wrappers:
+            wrapper.load_to_db(results=[])
+
+        if should_retry_message(error, attempt):
+            try:
+                db.run.update(filter={"run_id": run_id}, element={"status": "retrying", "error_msg": str(error)})
+            except Exception as db_error:
+                print(db_error)
+
+            # The retry resumes the comparison, so the candidates do not run again under new run ids
+            raise RetryMessageError(json.dumps({**job_parameters, "resume_run_id": run_id}), error) from error
+
+        db.run.update(filter={"run_id": run_id}, element={"status": "failed", "error_msg": str(error)})
+
+        raise RunFailedError(error) from error
+
+def publish_digit_run_messages(messages: list[dict], retry_attempt: int | None = None):
+    """
+    Publishes 'messages' on the queue of their priority, or on its retry exchange after the delay of 'retry_attempt'.
+    Uses its own connection, since the consumer one belongs to the listener thread.
+    """
+    rabbit_mq = Rabbit(RUN_QUEUES["batch"])
+    queues = {"batch": rabbit_mq}
 
     try:
+        for message in messages:
+            priority = get_run_priority(message)
+
+            if priority not in queues:
+                queues[priority] = Rabbit(RUN_QUEUES[priority], connection=rabbit_mq.connection)
+
+            if retry_attempt is not None:
+                if queues[priority].retry_levels == 0:
+                    queues[priority].declare_retry_queues(max_attempts=MESSAGE_MAX_ATTEMPTS, base_delay=MESSAGE_RETRY_DELAY)
+
+                queues[priority].publish_retry(json.dumps(message), retry_attempt)
+            else:
+                queues[priority].publish_message(message)
+    finally:
+        rabbit_mq.close()
+
+def start_sharded_run(run_id: str, job_parameters: dict, test_ids: list[str], shard_size: int, db: Mongo, generation: int = 0):
+    """
+    Splits the tests of a run into shards of 'shard_size' tests and publishes one 'shard' message per shard.
+    A resumed run is split again, with a new 'generation', so the shards left from its previous split are dropped.
+    """
+    shards = [test_ids[i:i + shard_size] for i in range(0, len(test_ids), shard_size)]
+
+    db.run.update(
+        filter={"run_id": run_id},
+        element={
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "shards": {"total": len(shards), "done": 0, "failed": 0, "generation": generation, "states": {str(i): "pending" for i in range(len(shards))}}
+        }
+    )
+
+    publish_digit_run_messages([
+        {**job_parameters, "type": "shard", "run_id": run_id, "shard": i, "test_ids": shard, "attempt": 1, "generation": generation}
+        for i, shard in enumerate(shards)
+    ])
+
+    print(f"Run '{run_id}' split into {len(shards)} shards of up to {shard_size} tests")
+
+def finalize_sharded_run(run: dict, db: Mongo):
+    results = [TestResult(**r) for r in db._get_interface_instance(run["run_id"]).get_all()]
+    shards = run["shards"]
+    elapsed_time = datetime.now(timezone.utc) - datetime.fromisoformat(run["started_at"])
+
+    status = "failed" if shards["failed"] > 0 else "done"
+
+    # Shards cancelled with their run count as failed
+    if run.get("cancel_requested"):
+        status = "cancelled"
+
+    db.run.update(
+        filter={"run_id": run["run_id"]},
+        element={
+            "status": status,
+            "error_msg": f'{shards["failed"]} of {shards["total"]} shards failed' if shards["failed"] > 0 else None,
+            "elapsed_time": f'{elapsed_time.total_seconds()} seconds',
+            "progress": {"completed": len(results), "total": run.get("number_of_tests", len(results))},
+            "summary": summarize_results(results),
+            # Shards report the metrics of their own calls, the run ones are rolled up from all the results
+            "metrics": summarize_metrics(results)
+        }
+    )
+
+def complete_shard(run_id: str, shard: int, state: str, db: Mongo, error: str | None = None):
+    """
+    Records a 'done' or 'failed' shard. The update only matches shards that are not finished yet,
+    so a redelivered shard is not counted twice and exactly one listener sees the last shard land.
+    """
+    run = db.run.increment(
+        filter={"run_id": run_id, f"shards.states.{shard}": {"$nin": ["done", "failed"]}},
+        increments={f"shards.{state}": 1},
+        element={f"shards.states.{shard}": state, f"shards.errors.{shard}": error}
+    )
+
+    if run is None:
+        return
+
+    if run["shards"]["done"] + run["shards"]["failed"] == run["shards"]["total"]:
+        finalize_sharded_run(run, db=db)
+
+def process_shard(job_parameters: dict, db: Mongo, queue_wait_time: float | None = None):
+    run_id = job_parameters["run_id"]
+    shard = job_parameters["shard"]
+    attempt = job_parameters.get("attempt", 1)
+
+    runs = db.run.match({"run_id": run_id})
+
+    if len(runs) == 0:
+        print(f"Run '{run_id}' not found. Dropping shard {shard}")
+        return
+
+    run = runs[0]
+
+    if run.get("shards") is None or run["shards"].get("generation", 0) != job_parameters.get("generation", 0):
+        print(f"Run '{run_id}' was split again since shard {shard} was published. Dropping it")
+        return
+
+    if run["shards"]["states"].get(str(shard)) in ["done", "failed"]:
+        print(f"Shard {shard} of '{run_id}' already processed")
+        return
+
+    if run.get("cancel_requested"):
+        complete_shard(run_id, shard, "failed", db=db, error="cancelled")
+        return
+
+    try:
+        job_parameters = {**get_resumed_job_parameters(run), **job_parameters}
+        judges = get_judges(job_parameters)
+        run_params = Parameters(**job_parameters.get("params", {}))
+
+        test_list = get_test_objects(tests=job_parameters["test_ids"], db=db)
+
+        # Results saved by a previous attempt of the shard are kept
+        finished, results_to_judge, human_judge_results = get_stored_results(run_id, db=db, judges=judges, test_ids=job_parameters["test_ids"])
+        stored = finished | {r.test_id for r in results_to_judge}
+        test_list = [t for t in test_list if t.test_id not in stored]
+
+        test_runner = TestRunnerService(
+            source=job_parameters.get('source', 'ollama'),
+            model_id=job_parameters.get('model', ''),
+            credentials=get_credentials(job_parameters),
+            tests=test_list,
+            judges=judges,
+            results_to_judge=results_to_judge,
+            parameters=run_params,
+            concurrency=Concurrency(**job_parameters.get("concurrency", {})),
+            response_cache=get_cache('response_cache', db) if job_parameters.get('response_cache', False) else None,
+            verdict_cache=get_cache('judge_cache', db) if job_parameters.get('judge_cache', False) else None,
+        )
+
+        wrapper = TestRunnerWrapper(
+            creator=job_parameters.get("user", ''),
+            test_runner=test_runner,
+            db=db,
+            tests=job_parameters.get("tests", "*"),
+            number_of_tests=run.get("number_of_tests", 0),
+            run_params=run_params.model_dump(),
+            run_id=run_id,
+            shard=shard,
+            human_judge_results=human_judge_results
+        )
+
+        db.run.update(
+            filter={"run_id": run_id},
+            element={f"shards.states.{shard}": "in progress", f"shards.queue_wait_times.{shard}": queue_wait_time}
+        )
+
+        wrapper.execute_tests()
+
+        # The tests of a model that went down during the shard failed fast, the shard is retried once it is back
+        if not wrapper.cancelled and get_circuit_breaker(job_parameters.get('source', 'ollama'), job_parameters.get('model', '')).state == 'open':
+            raise CircuitOpenError(f"'{job_parameters.get('model', '')}' became unavailable during shard {shard}")
+    except Exception as error:
+        print(f"Shard {shard} of '{run_id}' failed (attempt {attempt}/{SHARD_MAX_ATTEMPTS}): {error}")
+
+        if attempt < SHARD_MAX_ATTEMPTS:
+            db.run.update(filter={"run_id": run_id}, element={f"shards.states.{shard}": "retrying", f"shards.errors.{shard}": str(error)})
+            publish_digit_run_messages([{**job_parameters, "attempt": attempt + 1}], retry_attempt=attempt)
+        else:
+            complete_shard(run_id, shard, "failed", db=db, error=str(error))
+            raise RunFailedError(error) from error
+
+        return
+
+    if wrapper.cancelled:
+        complete_shard(run_id, shard, "failed", db=db, error="cancelled")
+        return
+
+    complete_shard(run_id, shard, "done", db=db)
+
+def process_run(job_parameters: dict, db: Mongo, queue_wait_time: float | None = None, attempt: int = 1):
+    wrapper = None
+    # Set once the run document exists, so a retry can resume it
+    run_id = None
+
+    try:
+        # Resuming keeps the 'run_id' and only runs the tests that don't have a result yet
+        resume_run_id = job_parameters.get("resume_run_id")
+        run = None
+
+        if resume_run_id is not None:
+            runs = db.run.match({"run_id": resume_run_id})
+
+            if len(runs) == 0:
+                raise Exception(f"Run '{resume_run_id}' not found")
+
+            run = runs[0]
+            run_id = resume_run_id
+
+            if run.get("type") == "comparison":
+                return process_comparison_run(job_parameters, db=db, queue_wait_time=queue_wait_time, attempt=attempt)
+
+            # A run cancelled while it was waiting for a retry is not resumed
+            if run.get("cancel_requested") and run.get("status") == "retrying":
+                db.run.update(filter={"run_id": resume_run_id}, element={"status": "cancelled"})
+                return
+            job_parameters = {**get_resumed_job_parameters(run), **job_parameters}
+
+        judges = get_judges(job_parameters)
+
         run_params:Parameters = Parameters(**job_parameters.get("params",{}))
         print("run_params", run_params)
+
+        concurrency: Concurrency = Concurrency(**job_parameters.get("concurrency", {}))
         
         # Get the tests
         tests = job_parameters.get('tests',"*")
         test_list = get_test_objects(tests=tests, db=db)
-        
+        number_of_tests = len(test_list)
+
+        finished, results_to_judge, human_judge_results = set(), [], {}
+
+        if run is not None:
+            finished, results_to_judge, human_judge_results = get_stored_results(resume_run_id, db=db, judges=judges)
+            stored = finished | {r.test_id for r in results_to_judge}
+            test_list = [t for t in test_list if t.test_id not in stored]
+
+            print(f"Resuming '{resume_run_id}': {len(finished)} finished, {len(results_to_judge)} to judge, {len(test_list)} to run")
+
+        # Resumed runs are split again on the tests they have left, including the results to judge again
+        pending_test_ids = [t.test_id for t in test_list] + [r.test_id for r in results_to_judge]
+        shard_size = int(job_parameters.get("shard_size", RUN_SHARD_SIZE))
+        sharded = shard_size > 0 and len(pending_test_ids) > shard_size
+
+        # The tests of a sharded run are loaded by its shards, its runner only gives the details of the run
         test_runner = TestRunnerService( 
             source=job_parameters.get('source', 'ollama'),
             model_id=job_parameters.get('model', ''),
-            credentials=Credentials(
-                watsonx_api_key=job_parameters.get('WX_API_KEY', WX_API_KEY), 
-                watsonx_project_id=job_parameters.get('WX_PROJECT_ID', WX_PROJECT_ID), 
-            ),
-            tests=test_list,
+            credentials=get_credentials(job_parameters),
+            tests=test_list if not sharded else [],
             judges=judges,
+            results_to_judge=results_to_judge if not sharded else [],
             parameters=run_params,
+            concurrency=concurrency,
+            response_cache=get_cache('response_cache', db) if job_parameters.get('response_cache', False) else None,
+            verdict_cache=get_cache('judge_cache', db) if job_parameters.get('judge_cache', False) else None,
         )
         
         wrapper = TestRunnerWrapper(
@@ -122,14 +713,17 @@ def process_digit_run(channel, delivery_tag, body):
             test_runner=test_runner,
             db=db,
             tests=tests,
-            number_of_tests=len(test_list),
-            run_params=run_params.model_dump()
+            number_of_tests=number_of_tests,
+            run_params=run_params.model_dump(),
+            run_id=resume_run_id,
+            completed_results=len(finished),
+            human_judge_results=human_judge_results
         )
         
         # LOG # # # # # # # # # # # # # #
         log = Log(
             item_id=wrapper.run_id,
-            method='POST',
+            method='PATCH' if run is not None else 'POST',
             payload=job_parameters,
             table='run',
             target_url='digit_run',
@@ -141,33 +735,84 @@ def process_digit_run(channel, delivery_tag, body):
         
         START_TIME = datetime.now(timezone.utc)
 
-        run_details = wrapper.get_details()
-
-        run_details['status'] = 'started'
-
-        db.run.save([run_details])
+        if run is None:
+            run_details = wrapper.get_details()
 
-        # t.build_config()
+            run_details['status'] = 'started'
+            run_details['priority'] = get_run_priority(job_parameters)
+            run_details['options'] = get_run_options(job_parameters)
+            run_details['queue_wait_time'] = queue_wait_time
 
-        # t.build_test_from_task()
-
-        db.run.update(filter={"run_id": wrapper.run_id}, element={"status": "in progress"})
-
-        results = wrapper.execute_tests()
+            db.run.save([run_details])
+            run_id = wrapper.run_id
 
-        wrapper.load_to_db(results=results)
+            db.run.update(filter={"run_id": wrapper.run_id}, element={"status": "in progress"})
+        else:
+            db.run.update(
+                filter={"run_id": wrapper.run_id},
+                element={
+                    "status": "in progress",
+                    "error_msg": None,
+                    "cancel_requested": False,
+                    "resumed_at": START_TIME.strftime('%Y-%m-%d %H:%M'),
+                    "resume_count": run.get("resume_count", 0) + 1,
+                    # Options set on the resume message apply to the next resumes as well
+                    "options": get_run_options(job_parameters),
+                    "queue_wait_time": queue_wait_time,
+                    "number_of_tests": number_of_tests,
+                    "progress": {"completed": len(finished), "total": number_of_tests}
+                }
+            )
+
+        if sharded:
+            # The shards are processed by any listener, the one finishing the last shard finalizes the run
+            generation = run.get("resume_count", 0) + 1 if run is not None else 0
+            start_sharded_run(wrapper.run_id, job_parameters, test_ids=pending_test_ids, shard_size=shard_size, db=db, generation=generation)
+            return
+
+        if run is not None and run.get("shards") is not None:
+            # A sharded run with few tests left is resumed here, the state of its previous shards no longer applies
+            db.run.update(filter={"run_id": wrapper.run_id}, element={"shards": None})
+
+        wrapper.execute_tests()
+
+        # The tests of a model that went down during the run failed fast, the run is resumed once it is back
+        if not wrapper.cancelled and get_circuit_breaker(job_parameters.get('source', 'ollama'), job_parameters.get('model', '')).state == 'open':
+            raise CircuitOpenError(f"'{job_parameters.get('model', '')}' became unavailable during the run")
 
         END_TIME = datetime.now(timezone.utc)
 
         db.run.update(
             filter={"run_id": wrapper.run_id},
-            element={"status": "done", "elapsed_time": f'{(END_TIME - START_TIME).total_seconds()} seconds'}
+            element={
+                "status": "cancelled" if wrapper.cancelled else "done",
+                "elapsed_time": f'{(END_TIME - START_TIME).total_seconds()} seconds',
+                **wrapper.get_stats()
+            }
         )
         
     except Exception as error:
         print(error)
 
-        if wrapper is None:
+        if should_retry_message(error, attempt):
+            retry_parameters = job_parameters
+
+            # The retry resumes the run, keeping its id and the results saved so far
+            if run_id is not None:
+                retry_parameters = {**job_parameters, "resume_run_id": run_id}
+
+                try:
+                    db.run.update(filter={"run_id": run_id}, element={"status": "retrying", "error_msg": str(error)})
+                    if wrapper is not None:
+                        wrapper.load_to_db(results=[])
+                except Exception as db_error:
+                    print(db_error)
+
+            raise RetryMessageError(json.dumps(retry_parameters), error) from error
+
+        if wrapper is None and job_parameters.get("resume_run_id") is not None:
+            db.run.update(filter={"run_id": job_parameters["resume_run_id"]}, element={"status": "failed", "error_msg": str(error)})
+        elif wrapper is None:
             creator = "<unknown>"
             if 'user' in job_parameters:
                 creator = job_parameters['user']
@@ -195,30 +840,104 @@ def process_digit_run(channel, delivery_tag, body):
             db.run.save([run_details])
         else:
             db.run.update(filter={"run_id": wrapper.run_id}, element={"status": "failed", "error_msg": str(error)})
-            wrapper.load_to_db()
+            wrapper.load_to_db(results=[])
+
+        raise RunFailedError(error) from error
+
+def process_digit_run(channel, delivery_tag, body, queued_at: datetime | None = None, attempt: int = 1, priority: RunPriority | None = None):
+    print(f'Test Runner: processing run: {body}')
+    db = Mongo()
+
+    job_parameters:dict = json.loads(body)
+
+    # The queue of the message decides the priority saved on the run, and carried by its retries and resumes
+    if priority is not None:
+        job_parameters["priority"] = priority
+    
+    print("job_parameters", job_parameters)
+
+    queue_wait_time = (datetime.now(timezone.utc) - queued_at).total_seconds() if queued_at is not None else None
+
+    if queue_wait_time is not None:
+        RABBITMQ_QUEUE_WAIT.labels(RUN_QUEUES[priority or "batch"]).observe(max(queue_wait_time, 0))
+
+    if job_parameters.get("type") == "shard":
+        process_shard(job_parameters, db=db, queue_wait_time=queue_wait_time)
+    elif job_parameters.get("candidates") is not None:
+        try:
+            process_comparison_run(job_parameters, db=db, queue_wait_time=queue_wait_time, attempt=attempt)
+        except Exception as error:
+            print(error)
+
+            if should_retry_message(error, attempt) or isinstance(error, RunFailedError):
+                raise
+
+            db.run.save([{
+                "run_id": "<unknown",
+                "type": "comparison",
+                "creator": job_parameters.get("user", "<unknown>"),
+                "tests": job_parameters.get("tests", "<unknown>"),
+                "created_at": datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M'),
+                "status": "failed",
+                "error_msg": f'message payload: {job_parameters}\nexception: {str(error)}'
+            }])
+
+            raise RunFailedError(error) from error
+    else:
+        process_run(job_parameters, db=db, queue_wait_time=queue_wait_time, attempt=attempt)
 
     ack_callback = functools.partial(ack_message, channel, delivery_tag)
 
     channel.connection.add_callback_threadsafe(ack_callback)
+    RABBITMQ_MESSAGES.labels(RUN_QUEUES[priority or "batch"], 'acked').inc()
+
+
+def poll_queue_metrics(queues: list[Rabbit]):
+    """Updates the depth of the queues of the listener, then schedules the next poll. Runs on the connection thread"""
+    try:
+        for rabbit_mq in queues:
+            for queue in [rabbit_mq.rmq_queue_name, rabbit_mq.dead_letter_queue]:
+                RABBITMQ_QUEUE_MESSAGES.labels(queue).set(rabbit_mq.get_message_count(queue))
+    except Exception as error:
+        print(f'ERROR Failed to poll the queue depth: {error}')
+
+    queues[0].connection.call_later(QUEUE_METRICS_INTERVAL, functools.partial(poll_queue_metrics, queues))
+
+def register_scheduler_metrics(scheduler: RunScheduler):
+    for priority in ("interactive", "batch"):
+        RUNS_IN_PROGRESS.labels(priority).set_function(lambda priority=priority: scheduler.running()[priority])
+        RUNS_PENDING.labels(priority).set_function(lambda priority=priority: scheduler.pending()[priority])
+
+def start_service_listener():
+    print(f'Connecting to RabbitMQ queues: {", ".join(RUN_QUEUES.values())}')
 
+    # Each queue is consumed on its own channel, with a prefetch count matching the runs the listener starts from it,
+    # so the deliveries start right away and the backlog stays in RabbitMQ for the other listeners
+    slots: dict[RunPriority, int] = {"batch": MAX_CONCURRENT_RUNS, "interactive": INTERACTIVE_CONCURRENT_RUNS}
+    rabbit_mq = Rabbit(RUN_QUEUES["batch"], prefetch_count=slots["batch"])
+    queues: dict[RunPriority, Rabbit] = {"batch": rabbit_mq}
 
-def start_service_listener(
-    queue_name: str = 'digit_run'
-):
-    print(f'Connecting to RabbitMQ queue: {queue_name}')
+    if slots["interactive"] > 0:
+        queues["interactive"] = Rabbit(RUN_QUEUES["interactive"], prefetch_count=slots["interactive"], connection=rabbit_mq.connection)
 
-    rabbit_mq = Rabbit(queue_name)
+    scheduler = RunScheduler(slots=slots)
 
-    message_callback = functools.partial(process_message, args=(process_digit_run))
+    for priority, queue in queues.items():
+        queue.declare_retry_queues(max_attempts=MESSAGE_MAX_ATTEMPTS, base_delay=MESSAGE_RETRY_DELAY)
+        queue.consume_messages(functools.partial(process_message, args=(process_digit_run, scheduler, queue, priority)))
 
-    rabbit_mq.consume_messages(message_callback)
+    register_scheduler_metrics(scheduler)
+    poll_queue_metrics(list(queues.values()))
+    start_metrics_server(RUNNER_METRICS_PORT)
 
     print('Waiting for messages. To exit press CTRL+C')
 
     try:
+        # The consumer loop of the connection delivers the messages of both channels
         rabbit_mq.start()
     except KeyboardInterrupt:
         rabbit_mq.stop()
+        scheduler.shutdown()
         rabbit_mq.close()
     except Exception as error:
         print('Error', error, flush=True)
@@ -0,0 +1,57 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Literal
+
+RunPriority = Literal["interactive", "batch"]
+
+class RunScheduler:
+    """
+    Runs the deliveries of a listener on a pool of threads, with 'slots[priority]' runs of each priority at a time.
+    Interactive runs come from their own queue and have their own slots, so they never wait for a batch run to finish
+    and the slots of batch runs are never held for them. Each queue is consumed with a prefetch count matching its slots,
+    so deliveries start right away and the backlog stays in RabbitMQ for the other listeners. Thread-safe.
+    """
+
+    def __init__(self, slots: dict[RunPriority, int]):
+        self.slots = slots
+
+        self.__lock = threading.Lock()
+        # Deliveries waiting for a slot, should a queue be consumed with a larger prefetch count
+        self.__queues: dict[RunPriority, deque[Callable[[], None]]] = {priority: deque() for priority in slots}
+        self.__running: dict[RunPriority, int] = {priority: 0 for priority in slots}
+        self.__executor = ThreadPoolExecutor(max_workers=sum(slots.values()), thread_name_prefix='digit-run')
+
+    def submit(self, priority: RunPriority, task: Callable[[], None]):
+        with self.__lock:
+            self.__queues[priority].append(task)
+
+        self._dispatch(priority)
+
+    def _dispatch(self, priority: RunPriority):
+        with self.__lock:
+            queue = self.__queues[priority]
+
+            while len(queue) > 0 and self.__running[priority] < self.slots[priority]:
+                self.__running[priority] += 1
+                self.__executor.submit(self._run, priority, queue.popleft())
+
+    def _run(self, priority: RunPriority, task: Callable[[], None]):
+        try:
+            task()
+        finally:
+            with self.__lock:
+                self.__running[priority] -= 1
+
+            self._dispatch(priority)
+
+    def pending(self) -> dict[RunPriority, int]:
+        with self.__lock:
+            return {priority: len(queue) for priority, queue in self.__queues.items()}
+
+    def running(self) -> dict[RunPriority, int]:
+        with self.__lock:
+            return dict(self.__running)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
@@ -1,2 +1,3 @@
 from test_runner_service.test_runner_svc import TestRunnerService
-from test_runner_service.schemas import Credentials, Judge, TestInput, TestResult, Parameters
\ No newline at end of file
+from test_runner_service.comparison_runner_svc import ComparisonRunnerService
+from test_runner_service.schemas import Credentials, Judge, TestInput, TestResult, Parameters, Concurrency, Candidate
\ No newline at end of file
@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from time import time
+from typing import Any
+
+from pymongo.collection import Collection
+
+from test_runner_service.utils import logger
+from grafite.metrics import CACHE_REQUESTS
+
+def cache_key(*parts: Any) -> str:
+    """Canonical hash of JSON-serializable parts. Dict key order does not change the key."""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'), ensure_ascii=False)
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class CacheStore:
+    """Persistent tier of a 'ResponseCache'."""
+
+    def get(self, key: str) -> Any | None:
+        raise NotImplementedError()
+
+    def set(self, key: str, value: Any, ttl: float | None) -> None:
+        raise NotImplementedError()
+
+class MongoCacheStore(CacheStore):
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+        # MongoDB removes expired entries in the background
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    def get(self, key: str) -> Any | None:
+        doc = self.collection.find_one({'_id': key})
+
+        if doc is None:
+            return None
+
+        # The TTL monitor only runs every minute, so expired documents may still be around
+        expires_at = doc.get('expires_at')
+        if expires_at is not None and expires_at.replace(tzinfo=timezone.utc) <= datetime.now(timezone.utc):
+            return None
+
+        return doc['value']
+
+    def set(self, key: str, value: Any, ttl: float | None) -> None:
+        doc = { '_id': key, 'value': value, 'expires_at': None }
+
+        if ttl is not None:
+            doc['expires_at'] = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+
+        self.collection.replace_one({'_id': key}, doc, upsert=True)
+
+class DiskCacheStore(CacheStore):
+    def __init__(self, path: str, max_entries: int | None = None):
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__writes = 0
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.__lock:
+            self.__connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)')
+            self.__connection.commit()
+
+    def get(self, key: str) -> Any | None:
+        now = time()
+
+        with self.__lock:
+            row = self.__connection.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+
+            if row is None:
+                return None
+
+            value, expires_at = row
+
+            if expires_at is not None and expires_at <= now:
+                self.__connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.__connection.commit()
+                return None
+
+            self.__connection.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+            self.__connection.commit()
+
+        return json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: float | None) -> None:
+        now = time()
+        expires_at = now + ttl if ttl is not None else None
+
+        with self.__lock:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires_at, now)
+            )
+            self.__writes += 1
+
+            # Eviction is amortized over the writes instead of running on every insert
+            if self.__writes % 100 == 0:
+                self.__evict(now)
+
+            self.__connection.commit()
+
+    def __evict(self, now: float):
+        self.__connection.execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+
+        if self.max_entries is not None:
+            self.__connection.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+class ResponseCache:
+    """
+    Two-tier cache: an in-process LRU in front of an optional persistent 'CacheStore'.
+    Entries expire after 'ttl' seconds ('None' keeps them until evicted) and the LRU
+    holds at most 'max_entries' items. Thread-safe.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float | None = None, store: CacheStore | None = None, name: str = 'cache'):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[str, tuple[Any, float | None]] = OrderedDict()
+        self.__stats = { 'hits': 0, 'misses': 0 }
+
+    def _get_from_memory(self, key: str) -> Any | None:
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+
+            if expires_at is not None and expires_at <= time():
+                del self.__entries[key]
+                return None
+
+            self.__entries.move_to_end(key)
+
+            return value
+
+    def _set_in_memory(self, key: str, value: Any):
+        expires_at = time() + self.ttl if self.ttl is not None else None
+
+        with self.__lock:
+            self.__entries[key] = (value, expires_at)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def _record(self, hit: bool):
+        CACHE_REQUESTS.labels(self.name, 'hit' if hit else 'miss').inc()
+
+        with self.__lock:
+            self.__stats['hits' if hit else 'misses'] += 1
+
+    def _get_from_store(self, key: str) -> Any | None:
+        try:
+            return self.store.get(key)
+        except Exception as e:
+            logger.error(f"Failed to read from the cache store: {e}")
+            return None
+
+    def _set_in_store(self, key: str, value: Any):
+        try:
+            self.store.set(key, value, self.ttl)
+        except Exception as e:
+            logger.error(f"Failed to write to the cache store: {e}")
+
+    def get(self, key: str) -> Any | None:
+        value = self._get_from_memory(key)
+
+        if value is None and self.store is not None:
+            value = self._get_from_store(key)
+
+            if value is not None:
+                self._set_in_memory(key, value)
+
+        self._record(hit=value is not None)
+
+        return value
+
+    def set(self, key: str, value: Any):
+        self._set_in_memory(key, value)
+
+        if self.store is not None:
+            self._set_in_store(key, value)
+
+    async def aget(self, key: str) -> Any | None:
+        # Memory hits are answered on the event loop, only the persistent tier goes to a thread
+        value = self._get_from_memory(key)
+
+        if value is None and self.store is not None:
+            value = await asyncio.to_thread(self._get_from_store, key)
+
+            if value is not None:
+                self._set_in_memory(key, value)
+
+        self._record(hit=value is not None)
+
+        return value
+
+    async def aset(self, key: str, value: Any):
+        self._set_in_memory(key, value)
+
+        if self.store is not None:
+            await asyncio.to_thread(self._set_in_store, key, value)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return { **self.__stats, 'entries': len(self.__entries) }
+
+    def view(self) -> 'CacheView':
+        return CacheView(self)
+
+class CacheView:
+    """Handle to a shared 'ResponseCache' that counts its own hits and misses, e.g. for a single run."""
+
+    def __init__(self, cache: ResponseCache):
+        self.cache = cache
+
+        self.__lock = threading.Lock()
+        self.__stats = { 'hits': 0, 'misses': 0 }
+
+    def _record(self, value: Any | None):
+        with self.__lock:
+            self.__stats['hits' if value is not None else 'misses'] += 1
+
+    def get(self, key: str) -> Any | None:
+        value = self.cache.get(key)
+        self._record(value)
+
+        return value
+
+    def set(self, key: str, value: Any):
+        self.cache.set(key, value)
+
+    async def aget(self, key: str) -> Any | None:
+        value = await self.cache.aget(key)
+        self._record(value)
+
+        return value
+
+    async def aset(self, key: str, value: Any):
+        await self.cache.aset(key, value)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(self.__stats)
@@ -0,0 +1,74 @@
+import asyncio
+
+from test_runner_service.schemas import Candidate, Credentials, Judge, TestResult, TestInput, Concurrency
+from test_runner_service.test_runner_svc import TestRunnerService, PipelineLimits
+from test_runner_service.event_loop import run_coroutine
+from test_runner_service.cache import ResponseCache
+from test_runner_service.utils import summarize_results
+
+class ComparisonRunnerService:
+    """
+    Runs the same tests against several candidate models. The candidates share one generation worker pool
+    and one judging pipeline, so the total number of in-flight calls is bounded by 'concurrency'
+    regardless of the number of candidates.
+    """
+    candidates: list[Candidate]
+    runners: list[TestRunnerService]
+    __limits: PipelineLimits
+
+    def __init__(
+        self,
+        candidates: list[Candidate],
+        credentials: Credentials,
+        tests: list[TestInput],
+        judges: list[Judge] = [],
+        concurrency: Concurrency = Concurrency(),
+        response_cache: ResponseCache | None = None,
+        verdict_cache: ResponseCache | None = None,
+        logs_dir_path: str | None = None,
+        candidate_tests: list[list[TestInput]] | None = None,
+        results_to_judge: list[list[TestResult]] | None = None
+    ):
+        if len(candidates) == 0:
+            raise Exception("At least one candidate is required")
+
+        self.candidates = candidates
+
+        # A resumed comparison runs, per candidate, the tests it has no result for and judges again its failed verdicts
+        candidate_tests = candidate_tests or [tests] * len(candidates)
+        results_to_judge = results_to_judge or [[]] * len(candidates)
+
+        # Every runner registers its limits, so the shared pool fits the least restricted candidate
+        self.__limits = PipelineLimits()
+        self.runners = [
+            TestRunnerService(
+                source=candidate.source,
+                model_id=candidate.model_id,
+                credentials=credentials,
+                tests=candidate_tests[i],
+                judges=judges,
+                results_to_judge=results_to_judge[i],
+                parameters=candidate.parameters,
+                concurrency=concurrency,
+                response_cache=response_cache,
+                verdict_cache=verdict_cache,
+                limits=self.__limits,
+                logs_dir_path=logs_dir_path if i == 0 else None
+            )
+            for i, candidate in enumerate(candidates)
+        ]
+
+    async def arun(self) -> list[list[TestResult]]:
+        """Results of each candidate, in the order of 'candidates'"""
+        return list(await asyncio.gather(*[runner.arun() for runner in self.runners]))
+
+    def run(self) -> list[list[TestResult]]:
+        return run_coroutine(self.arun())
+
+    @staticmethod
+    def summarize(candidates: list[Candidate], results: list[list[TestResult]]) -> list[dict]:
+        """Side-by-side scores of the candidates"""
+        return [
+            { 'source': candidate.source, 'model_id': candidate.model_id, **summarize_results(candidate_results) }
+            for candidate, candidate_results in zip(candidates, results)
+        ]
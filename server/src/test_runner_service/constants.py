@@ -1,3 +1,60 @@
-RETRY_TIME = 5
-MAX_RETRY_ATTEMPS = 5
-MAX_WORKERS = 1
\ No newline at end of file
+import os
+
+MAX_WORKERS = 1
+
+# Failed provider calls are retried on transient errors with exponential backoff and full jitter,
+# starting at RETRY_BASE_DELAY and capped at RETRY_MAX_DELAY seconds
+MAX_RETRY_ATTEMPS = int(os.getenv('MAX_RETRY_ATTEMPTS', 5))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 30))
+
+# A provider model failing CIRCUIT_BREAKER_THRESHOLD calls in a row is skipped
+# for CIRCUIT_BREAKER_RESET_TIMEOUT seconds before it is tried again
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+
+# Default number of concurrent requests sent to each provider source.
+# Can be overridden per run through 'Concurrency'.
+SOURCE_MAX_WORKERS = {
+    'ollama': int(os.getenv('OLLAMA_MAX_WORKERS', 4)),
+    'watsonx': int(os.getenv('WATSONX_MAX_WORKERS', 8)),
+}
+
+# Number of generated results that may wait for a free judging worker
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 16))
+
+# Response caches (opt-in per run). CACHE_STORE is the persistent tier: 'mongo', 'disk' or 'memory'
+CACHE_STORE = os.getenv('CACHE_STORE', 'mongo')
+CACHE_DIR = os.getenv('CACHE_DIR', '.cache')
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+CACHE_TTL = float(os.getenv('CACHE_TTL', 7 * 24 * 60 * 60))
+
+# Provider calls are recorded to ('record') or served from ('replay') the cassette file CASSETTE_PATH.
+# Empty calls the providers normally
+CASSETTE_MODE = os.getenv('CASSETTE_MODE', '')
+CASSETTE_PATH = os.getenv('CASSETTE_PATH', '.cache/providers.cassette')
+
+# Results are saved in bulk writes of up to RESULTS_FLUSH_BATCH_SIZE results,
+# at least every RESULTS_FLUSH_INTERVAL seconds while a run is in progress
+RESULTS_FLUSH_BATCH_SIZE = int(os.getenv('RESULTS_FLUSH_BATCH_SIZE', 50))
+RESULTS_FLUSH_INTERVAL = float(os.getenv('RESULTS_FLUSH_INTERVAL', 10))
+
+# Every PROGRESS_INTERVAL seconds a run publishes its progress on the run document and checks whether it was cancelled
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', 2))
+
+# Client-side rate limits per provider source, shared by all the runs of the process.
+# 0 disables a limit. The request rate adapts to 429/503 responses (AIMD) between
+# RATE_LIMIT_MIN_RPS and the configured maximum.
+SOURCE_RATE_LIMITS = {
+    'ollama': {
+        'rps': float(os.getenv('OLLAMA_MAX_RPS', 20)),
+        'tpm': float(os.getenv('OLLAMA_MAX_TPM', 0)),
+    },
+    'watsonx': {
+        'rps': float(os.getenv('WATSONX_MAX_RPS', 8)),
+        'tpm': float(os.getenv('WATSONX_MAX_TPM', 0)),
+    },
+}
+RATE_LIMIT_MIN_RPS = float(os.getenv('RATE_LIMIT_MIN_RPS', 0.2))
+RATE_LIMIT_INCREASE = float(os.getenv('RATE_LIMIT_INCREASE', 0.1))
+RATE_LIMIT_DECREASE = float(os.getenv('RATE_LIMIT_DECREASE', 0.5))
@@ -0,0 +1,24 @@
+import asyncio
+import threading
+from typing import Any, Coroutine
+
+_loop: asyncio.AbstractEventLoop | None = None
+_lock = threading.Lock()
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the process-wide event loop shared by all the runs, starting it on first use.
+    Sharing the loop lets async clients and their connection pools outlive a single run.
+    """
+    global _loop
+
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='test-runner-event-loop', daemon=True).start()
+
+    return _loop
+
+def run_coroutine(coro: Coroutine[Any, Any, Any]) -> Any:
+    """Runs 'coro' on the shared event loop and blocks the calling thread until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
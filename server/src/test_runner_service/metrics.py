@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Iterator
+
+from test_runner_service.schemas import CallMetrics
+
+# Metrics of the call being made by the current task. Threads started with 'asyncio.to_thread' see the same instance
+_current_call: ContextVar[CallMetrics | None] = ContextVar('current_call', default=None)
+
+@contextmanager
+def record_call() -> Iterator[CallMetrics]:
+    """Times the block and collects the usage, retries and waits of the provider calls made in it."""
+    metrics = CallMetrics()
+    token = _current_call.set(metrics)
+    start = perf_counter()
+
+    try:
+        yield metrics
+    finally:
+        metrics.wall_time = round(perf_counter() - start, 4)
+        _current_call.reset(token)
+
+def get_current_call() -> CallMetrics | None:
+    return _current_call.get()
+
+def record_usage(prompt_tokens: int | None, completion_tokens: int | None):
+    metrics = _current_call.get()
+
+    if metrics is None:
+        return
+
+    if prompt_tokens is not None:
+        metrics.prompt_tokens = (metrics.prompt_tokens or 0) + prompt_tokens
+
+    if completion_tokens is not None:
+        metrics.completion_tokens = (metrics.completion_tokens or 0) + completion_tokens
+
+def record_retry():
+    metrics = _current_call.get()
+
+    if metrics is not None:
+        metrics.retries += 1
+
+def record_rate_limit_wait(seconds: float):
+    metrics = _current_call.get()
+
+    if metrics is not None:
+        metrics.rate_limit_wait = round(metrics.rate_limit_wait + seconds, 4)
+
+def record_first_token(started_at: float):
+    """Sets the time to first token of a streamed call started at 'started_at' ('perf_counter' time)"""
+    metrics = _current_call.get()
+
+    if metrics is not None and metrics.ttft is None:
+        metrics.ttft = round(perf_counter() - started_at, 4)
+
+def record_cache_hit():
+    metrics = _current_call.get()
+
+    if metrics is not None:
+        metrics.cached = True
+
+def record_early_stop():
+    metrics = _current_call.get()
+
+    if metrics is not None:
+        metrics.early_stopped = True
@@ -0,0 +1,130 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Any
+
+# A cassette starts with MAGIC, followed by records: the SHA-256 digest of the request key,
+# the payload length and the zlib-compressed JSON payload. Each record is compressed on its own,
+# so the file can be appended to and a single response read without decompressing the others.
+MAGIC = b'GRAFITE-CASSETTE-1\n'
+RECORD_HEADER = struct.Struct('>32sI')
+
+def read_index(buffer: bytes | mmap.mmap) -> dict[bytes, tuple[int, int]]:
+    """Offset and length of the payload of each request digest. The first record of a digest wins and a truncated last record is ignored."""
+    if len(buffer) == 0:
+        return {}
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise Exception('Not a cassette file')
+
+    index: dict[bytes, tuple[int, int]] = {}
+    position = len(MAGIC)
+
+    while position + RECORD_HEADER.size <= len(buffer):
+        digest, length = RECORD_HEADER.unpack_from(buffer, position)
+        position += RECORD_HEADER.size
+
+        # Left by a recorder that stopped while writing
+        if position + length > len(buffer):
+            break
+
+        index.setdefault(digest, (position, length))
+        position += length
+
+    return index
+
+class CassetteRecorder:
+    """Appends request/response records to a cassette file. Requests already recorded are skipped. Thread-safe."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self.__lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        self.__recorded: set[bytes] = set()
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                self.__recorded = set(read_index(buffer))
+
+        self.__file = open(path, 'ab')
+
+        if self.__file.tell() == 0:
+            self.__file.write(MAGIC)
+            self.__file.flush()
+
+    def record(self, key: str, request: dict, response: Any, usage: tuple[int | None, int | None] = (None, None)):
+        digest = bytes.fromhex(key)
+        payload = zlib.compress(json.dumps({ 'request': request, 'response': response, 'usage': usage }, default=str).encode())
+
+        with self.__lock:
+            if digest in self.__recorded:
+                return
+
+            # A single write per record, so processes appending to the same cassette do not interleave
+            self.__file.write(RECORD_HEADER.pack(digest, len(payload)) + payload)
+            self.__file.flush()
+            self.__recorded.add(digest)
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__recorded)
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+class CassettePlayer:
+    """
+    Serves the responses of a cassette file. The file is memory-mapped and indexed once,
+    payloads are only decompressed when their request is replayed. Thread-safe.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # An empty file cannot be mapped
+            self.__buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+
+        self.__index = read_index(self.__buffer)
+
+    def get(self, key: str) -> dict | None:
+        """Payload recorded for 'key': the 'request', its 'response' and its token 'usage'"""
+        entry = self.__index.get(bytes.fromhex(key))
+
+        if entry is None:
+            return None
+
+        offset, length = entry
+
+        return json.loads(zlib.decompress(self.__buffer[offset:offset + length]))
+
+    def __len__(self) -> int:
+        return len(self.__index)
+
+_recorders: dict[str, CassetteRecorder] = {}
+_players: dict[str, CassettePlayer] = {}
+_lock = threading.Lock()
+
+def get_cassette_recorder(path: str) -> CassetteRecorder:
+    """Returns the process-wide recorder of a cassette file."""
+    with _lock:
+        if path not in _recorders:
+            _recorders[path] = CassetteRecorder(path)
+
+        return _recorders[path]
+
+def get_cassette_player(path: str) -> CassettePlayer:
+    """Returns the process-wide player of a cassette file. The file is indexed on first use."""
+    with _lock:
+        if path not in _players:
+            _players[path] = CassettePlayer(path)
+
+        return _players[path]
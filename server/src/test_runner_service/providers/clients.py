@@ -0,0 +1,36 @@
+import asyncio
+import threading
+from typing import Callable, Hashable, TypeVar
+from weakref import WeakKeyDictionary
+
+T = TypeVar('T')
+
+_lock = threading.Lock()
+_clients: dict[Hashable, object] = {}
+_async_clients: WeakKeyDictionary[asyncio.AbstractEventLoop, dict[Hashable, object]] = WeakKeyDictionary()
+
+def get_client(key: Hashable, factory: Callable[[], T]) -> T:
+    """
+    Returns the long-lived client stored under 'key', creating it with 'factory' on first use.
+    Sync clients are thread-safe and shared by the whole process.
+    """
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+
+        return _clients[key]
+
+def get_async_client(key: Hashable, factory: Callable[[], T]) -> T:
+    """
+    Same as 'get_client' for async clients. Their connection pools are bound to an event loop,
+    so clients are cached per running loop.
+    """
+    loop = asyncio.get_running_loop()
+
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+
+        if key not in clients:
+            clients[key] = factory()
+
+        return clients[key]
@@ -1,33 +1,56 @@
-from time import sleep
+from time import perf_counter
+from typing import AsyncIterator
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 from test_runner_service.schemas import Parameters
 from test_runner_service.utils import logger
-from test_runner_service.constants import MAX_RETRY_ATTEMPS, RETRY_TIME
 from grafite.constants import OLLAMA_BASE_URL
 
 from .provider import Provider
+from .clients import get_client, get_async_client
+from .rate_limiter import estimate_tokens
 
 class OllamaProvider(Provider):
-    def __init__(self):
-        self.__current_retry_attempts = 0
+    source = 'ollama'
+    streaming = True
+
+    # Retries are handled by 'Provider.retry_policy', so the clients must not retry on their own
+    def _get_client(self) -> OpenAI:
+        return get_client(('ollama', OLLAMA_BASE_URL), lambda: OpenAI(base_url=OLLAMA_BASE_URL, api_key="ollama", max_retries=0))
+
+    def _get_async_client(self) -> AsyncOpenAI:
+        return get_async_client(('ollama', OLLAMA_BASE_URL), lambda: AsyncOpenAI(base_url=OLLAMA_BASE_URL, api_key="ollama", max_retries=0))
+
+    def _get_body_params(self, parameters: Parameters) -> dict:
+        body_params = {
+            **parameters.additional_params,
+            'max_tokens': parameters.max_tokens,
+            'temperature': parameters.temperature,
+            'top_p': parameters.top_p,
+            'frequency_penalty': parameters.frequency_penalty,
+            'presence_penalty': parameters.presence_penalty,
+        }
+
+        if parameters.response_format is not None:
+            body_params['response_format'] = parameters.response_format
+        logger.info(f"Ollama extra_body: {body_params}")
+
+        return body_params
+
+    def _get_token_usage(self, res) -> tuple[int | None, int | None]:
+        # Streams report their usage in their last chunk
+        if getattr(res, 'usage', None) is None:
+            return None, None
+
+        return res.usage.prompt_tokens, res.usage.completion_tokens
 
     def chat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None):
-        try:
-            client = OpenAI(base_url=OLLAMA_BASE_URL, api_key="ollama")
-
-            body_params = {
-                **parameters.additional_params,
-                'max_tokens': parameters.max_tokens,
-                'temperature': parameters.temperature,
-                'top_p': parameters.top_p,
-                'frequency_penalty': parameters.frequency_penalty,
-                'presence_penalty': parameters.presence_penalty,
-            }
-            logger.info(f"Ollama extra_body: {body_params}")
-
-            res = client.chat.completions.create(
+        client = self._get_client()
+
+        res = self._call(
+            model_id,
+            lambda: client.chat.completions.create(
                 model=model_id,
                 messages=messages,
                 tools=tools,
@@ -35,65 +58,119 @@ class OllamaProvider(Provider):
                 extra_headers={
                     "Content-Type": "application/json"
                 },
-                extra_body=body_params
-            )
+                extra_body=self._get_body_params(parameters)
+            ),
+            reserved_tokens=estimate_tokens(messages, parameters)
+        )
 
-            return res.choices[0].message.model_dump()
-        except Exception as e:
-            self.__current_retry_attempts += 1
-
-            if self.__current_retry_attempts > MAX_RETRY_ATTEMPS:
-                err_message = f"Max number of retries ({MAX_RETRY_ATTEMPS}) exceeded. Error:\nFailed to generate model response: " + str(e)
-                logger.error(err_message)
-                raise Exception(err_message)
-        
-            logger.error("Failed to generate model response: " + str(e))
-            logger.info(f"Retrying in {RETRY_TIME} seconds...")
-            sleep(RETRY_TIME)
-
-            return self.chat(model_id=model_id, messages=messages, tools=tools, parameters=parameters)
+        return res.choices[0].message.model_dump()
 
     def completions(self, model_id: str, prompt: str, parameters: Parameters):
-        try:
-            client = OpenAI(base_url=OLLAMA_BASE_URL, api_key="ollama")
-
-            body_params = {
-                **parameters.additional_params,
-                'max_tokens': parameters.max_tokens,
-                'temperature': parameters.temperature,
-                'top_p': parameters.top_p,
-                'frequency_penalty': parameters.frequency_penalty,
-                'presence_penalty': parameters.presence_penalty,
-            }
-            logger.info(f"Ollama extra_body: {body_params}")
-
-            res = client.completions.create(
+        client = self._get_client()
+
+        res = self._call(
+            model_id,
+            lambda: client.completions.create(
                 model=model_id,
                 prompt=prompt,
                 extra_headers={
                     "Content-Type": "application/json"
                 },
-                extra_body=body_params
-            )
+                extra_body=self._get_body_params(parameters)
+            ),
+            reserved_tokens=estimate_tokens(prompt, parameters)
+        )
 
-            return res.choices[0].text
-        except Exception as e:
-            self.__current_retry_attempts += 1
-
-            if self.__current_retry_attempts > MAX_RETRY_ATTEMPS:
-                err_message = f"Max number of retries ({MAX_RETRY_ATTEMPS}) exceeded. Error:\nFailed to generate model response: " + str(e)
-                logger.error(err_message)
-                raise Exception(err_message)
-        
-            logger.error("Failed to generate model response: " + str(e))
-            logger.info(f"Retrying in {RETRY_TIME} seconds...")
-            sleep(RETRY_TIME)
-
-            return self.completions(model_id=model_id, prompt=prompt, parameters=parameters)
+        return res.choices[0].text
 
+    async def achat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None):
+        client = self._get_async_client()
 
+        res = await self._acall(
+            model_id,
+            lambda: client.chat.completions.create(
+                model=model_id,
+                messages=messages,
+                tools=tools,
+                tool_choice="auto" if tools is not None else "none",
+                extra_headers={
+                    "Content-Type": "application/json"
+                },
+                extra_body=self._get_body_params(parameters)
+            ),
+            reserved_tokens=estimate_tokens(messages, parameters)
+        )
 
+        return res.choices[0].message.model_dump()
 
+    async def acompletions(self, model_id: str, prompt: str, parameters: Parameters):
+        client = self._get_async_client()
 
+        res = await self._acall(
+            model_id,
+            lambda: client.completions.create(
+                model=model_id,
+                prompt=prompt,
+                extra_headers={
+                    "Content-Type": "application/json"
+                },
+                extra_body=self._get_body_params(parameters)
+            ),
+            reserved_tokens=estimate_tokens(prompt, parameters)
+        )
+
+        return res.choices[0].text
+
+    async def achat_stream(self, model_id: str, messages: list[dict], parameters: Parameters) -> AsyncIterator[str]:
+        client = self._get_async_client()
+        reserved_tokens = estimate_tokens(messages, parameters)
+        started_at = perf_counter()
+
+        # Throttling and connection errors happen when the stream is opened, so they are retried like any other call
+        stream = await self._acall(
+            model_id,
+            lambda: client.chat.completions.create(
+                model=model_id,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                extra_headers={
+                    "Content-Type": "application/json"
+                },
+                extra_body=self._get_body_params(parameters)
+            ),
+            reserved_tokens=reserved_tokens,
+            stream=True
+        )
 
+        usage = None
+        chunks = 0
+        error = None
 
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    chunks += 1
+                    yield chunk.choices[0].delta.content
+        except GeneratorExit:
+            # Closed by the caller, e.g. once it holds a verdict
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # Closing the connection stops the generation
+            await stream.close()
+
+            # A stopped stream gets no usage chunk, its chunks are counted instead, along with the estimate of its prompt
+            if usage is not None:
+                self._record_usage(model_id, usage.prompt_tokens, usage.completion_tokens)
+                used_tokens = usage.prompt_tokens + usage.completion_tokens
+            else:
+                self._record_usage(model_id, None, chunks)
+                used_tokens = estimate_tokens(messages) + chunks
+
+            self._on_stream_end(model_id, reserved_tokens, used_tokens, started_at, error)
@@ -1,26 +1,316 @@
-from test_runner_service.schemas import Judge, JudgeResponse, TestResult, Parameters
-from test_runner_service.utils import get_judge_prompt, post_process_judge_response
-from grafite.constants import JUDGE_SYSTEM_PROMPT
+import asyncio
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from test_runner_service.schemas import Judge, JudgeResponse, TestResult, Parameters, ModelSource
+from test_runner_service.utils import get_judge_prompt, post_process_judge_response, VerdictScanner
+from test_runner_service.cache import ResponseCache, CacheView, cache_key
+from test_runner_service.metrics import record_usage, record_rate_limit_wait, record_cache_hit, record_first_token, record_early_stop
+from grafite.constants import JUDGE_SYSTEM_PROMPT, JUDGE_STREAMING
+from grafite.metrics import PROVIDER_CALLS, PROVIDER_CALL_DURATION, PROVIDER_CALLS_IN_FLIGHT, PROVIDER_RETRIES, PROVIDER_TOKENS, JUDGE_VERDICTS, JUDGE_EARLY_STOPS
+
+from .rate_limiter import get_rate_limiter, is_throttling_error
+from .retry import RetryPolicy, get_circuit_breaker
+
+# JSON schema of a verdict, requested from judges with 'structured_output'
+VERDICT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "verdict",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "justification": { "type": "string" },
+                "score": { "type": "integer", "enum": [0, 1] }
+            },
+            "required": ["justification", "score"],
+            "additionalProperties": False
+        }
+    }
+}
 
 class Provider:
+    source: ModelSource
+    retry_policy: RetryPolicy = RetryPolicy()
+    # Set by the providers implementing 'achat_stream'
+    streaming: bool = False
+
     def chat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None) -> dict:
         raise NotImplementedError()
     
     def completions(self, model_id: str, prompt: str, parameters: Parameters) -> str:
         raise NotImplementedError()
 
-    def judge(self, judge: Judge, result: TestResult, parameters: Parameters | dict) -> JudgeResponse:
+    # Async variants default to running the sync methods in a thread.
+    # Providers with a native async client should override them.
+    async def achat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None) -> dict:
+        return await asyncio.to_thread(self.chat, model_id=model_id, messages=messages, parameters=parameters, tools=tools)
+
+    async def acompletions(self, model_id: str, prompt: str, parameters: Parameters) -> str:
+        return await asyncio.to_thread(self.completions, model_id=model_id, prompt=prompt, parameters=parameters)
+
+    def achat_stream(self, model_id: str, messages: list[dict], parameters: Parameters | dict) -> AsyncIterator[str]:
+        """Content deltas of a streamed chat call. Closing the iterator stops the call."""
+        raise NotImplementedError()
+
+    def _get_token_usage(self, res: Any) -> tuple[int | None, int | None]:
+        """Prompt and completion tokens of a call, as reported by the provider response."""
+        return None, None
+
+    def _get_used_tokens(self, res: Any) -> int | None:
+        """Tokens consumed by a call, as reported by the provider response."""
+        prompt_tokens, completion_tokens = self._get_token_usage(res)
+
+        if prompt_tokens is None and completion_tokens is None:
+            return None
+
+        return (prompt_tokens or 0) + (completion_tokens or 0)
+
+    def _record_usage(self, model_id: str, prompt_tokens: int | None, completion_tokens: int | None):
+        record_usage(prompt_tokens, completion_tokens)
+
+        if prompt_tokens is not None:
+            PROVIDER_TOKENS.labels(self.source, model_id, 'prompt').inc(prompt_tokens)
+        if completion_tokens is not None:
+            PROVIDER_TOKENS.labels(self.source, model_id, 'completion').inc(completion_tokens)
+
+    def _on_success(self, model_id: str, limiter, reserved_tokens: int, res: Any):
+        prompt_tokens, completion_tokens = self._get_token_usage(res)
+
+        limiter.on_success(reserved_tokens, self._get_used_tokens(res))
+        self._record_usage(model_id, prompt_tokens, completion_tokens)
+
+    def _on_stream_end(self, model_id: str, reserved_tokens: int, used_tokens: int | None, started_at: float, error: BaseException | None):
+        """Accounts a stream opened with '_acall(stream=True)' once it is over, 'started_at' being taken before it was opened."""
+        limiter = get_rate_limiter(self.source, model_id)
+
+        # A stream failing midway was still answered, so it only gives back the tokens it did not use
+        if error is None:
+            limiter.on_success(reserved_tokens, used_tokens)
+        else:
+            limiter.reconcile(reserved_tokens, used_tokens)
+
+        self._observe_call(model_id, started_at, error)
+
+    def _observe_call(self, model_id: str, started_at: float, error: BaseException | None):
+        PROVIDER_CALLS_IN_FLIGHT.labels(self.source, model_id).dec()
+        PROVIDER_CALL_DURATION.labels(self.source, model_id).observe(perf_counter() - started_at)
+        PROVIDER_CALLS.labels(self.source, model_id, 'error' if error is not None else 'success').inc()
+
+    def _call(self, model_id: str, fn: Callable[[], Any], reserved_tokens: int = 0) -> Any:
+        """Calls the provider through the rate limiter, the retry policy and the circuit breaker of the model."""
+        limiter = get_rate_limiter(self.source, model_id)
+        attempts = 0
+
+        def attempt():
+            nonlocal attempts
+            attempts += 1
+
+            if attempts > 1:
+                PROVIDER_RETRIES.labels(self.source, model_id).inc()
+
+            answered = False
+
+            try:
+                started_at = perf_counter()
+                limiter.acquire(reserved_tokens)
+                record_rate_limit_wait(perf_counter() - started_at)
+
+                res = fn()
+                answered = True
+            except Exception as e:
+                if is_throttling_error(e):
+                    limiter.on_throttle()
+                raise
+            finally:
+                # The tokens of a failed or interrupted call are not counted by the provider, so its reservation is given back
+                if not answered:
+                    limiter.reconcile(reserved_tokens, 0)
+
+            self._on_success(model_id, limiter, reserved_tokens, res)
+
+            return res
+
+        started_at = perf_counter()
+        PROVIDER_CALLS_IN_FLIGHT.labels(self.source, model_id).inc()
+
+        try:
+            res = self.retry_policy.call(attempt, breaker=get_circuit_breaker(self.source, model_id))
+        except Exception as e:
+            self._observe_call(model_id, started_at, e)
+            raise
+
+        self._observe_call(model_id, started_at, None)
+
+        return res
+
+    async def _acall(self, model_id: str, fn: Callable[[], Awaitable[Any]], reserved_tokens: int = 0, stream: bool = False) -> Any:
+        """
+        Async '_call'. With 'stream', 'fn' opens a stream, which is only over once it is consumed or closed:
+        its reservation and duration are then accounted by '_on_stream_end', not when it is opened.
+        """
+        limiter = get_rate_limiter(self.source, model_id)
+        attempts = 0
+
+        async def attempt():
+            nonlocal attempts
+            attempts += 1
+
+            if attempts > 1:
+                PROVIDER_RETRIES.labels(self.source, model_id).inc()
+
+            answered = False
+
+            try:
+                started_at = perf_counter()
+                await limiter.aacquire(reserved_tokens)
+                record_rate_limit_wait(perf_counter() - started_at)
+
+                res = await fn()
+                answered = True
+            except Exception as e:
+                if is_throttling_error(e):
+                    limiter.on_throttle()
+                raise
+            finally:
+                # Also covers calls cancelled while waiting for the limiter or the provider
+                if not answered:
+                    limiter.reconcile(reserved_tokens, 0)
+
+            if not stream:
+                self._on_success(model_id, limiter, reserved_tokens, res)
+
+            return res
+
+        started_at = perf_counter()
+        PROVIDER_CALLS_IN_FLIGHT.labels(self.source, model_id).inc()
+
+        try:
+            res = await self.retry_policy.acall(attempt, breaker=get_circuit_breaker(self.source, model_id))
+        except BaseException as e:
+            # Also covers cancelled calls, so the in-flight gauge goes back down
+            self._observe_call(model_id, started_at, e)
+            raise
+
+        if not stream:
+            self._observe_call(model_id, started_at, None)
+
+        return res
+
+    def _get_judge_messages(self, result: TestResult) -> list[dict]:
         prompt = get_judge_prompt(result=result)
         messages = [{ "role": "user", "content": prompt }]
         
         if JUDGE_SYSTEM_PROMPT:
             messages = [{ "role": "system", "content":JUDGE_SYSTEM_PROMPT}] + messages
-        
+
+        return messages
+
+    def _get_judge_parameters(self, judge: Judge, parameters: Parameters | dict) -> Parameters | dict:
+        if not judge.structured_output:
+            return parameters
+
+        if isinstance(parameters, dict):
+            return { 'response_format': VERDICT_RESPONSE_FORMAT, **parameters }
+
+        if parameters.response_format is not None:
+            return parameters
+
+        return parameters.model_copy(update={ 'response_format': VERDICT_RESPONSE_FORMAT })
+
+    def _parse_verdict(self, judge: Judge, output: str) -> JudgeResponse:
+        verdict = post_process_judge_response(output, model_id=judge.model_id)
+        JUDGE_VERDICTS.labels(judge.model_id, 'parse_error' if verdict.parse_error else 'parsed').inc()
+
+        return verdict
+
+    def _get_verdict_key(self, judge: Judge, messages: list[dict], parameters: Parameters | dict) -> str:
+        return cache_key(
+            'judge',
+            judge.source,
+            judge.model_id,
+            messages,
+            parameters.model_dump() if isinstance(parameters, Parameters) else parameters
+        )
+
+    def judge(self, judge: Judge, result: TestResult, parameters: Parameters | dict, cache: ResponseCache | CacheView | None = None) -> JudgeResponse:
+        messages = self._get_judge_messages(result=result)
+        parameters = self._get_judge_parameters(judge, parameters)
+
+        if cache is not None:
+            key = self._get_verdict_key(judge, messages, parameters)
+            verdict = cache.get(key)
+
+            if verdict is not None:
+                record_cache_hit()
+                return JudgeResponse(**verdict)
+
         judge_response = self.chat(
             model_id=judge.model_id, 
             messages=messages, 
             parameters=parameters
         )
 
-        
-        return post_process_judge_response(judge_response['content'] if 'content' in judge_response else '', model_id=judge.model_id)
\ No newline at end of file
+        verdict = self._parse_verdict(judge, judge_response['content'] if 'content' in judge_response else '')
+
+        # Unparsable outputs are not cached, so the next run asks the judge again
+        if cache is not None and not verdict.parse_error:
+            cache.set(key, verdict.model_dump())
+
+        return verdict
+
+    async def _astream_judge_call(self, model_id: str, messages: list[dict], parameters: Parameters | dict) -> str:
+        """Streams the judge output and stops the call as soon as it holds a complete verdict."""
+        scanner = VerdictScanner()
+        started_at = perf_counter()
+        stream = self.achat_stream(model_id=model_id, messages=messages, parameters=parameters)
+
+        try:
+            async for delta in stream:
+                record_first_token(started_at)
+
+                if scanner.feed(delta) is not None:
+                    break
+        finally:
+            await stream.aclose()
+
+        if scanner.verdict is None:
+            return scanner.text
+
+        # The tokens streamed until the verdict are recorded as the usage of the call
+        record_early_stop()
+        JUDGE_EARLY_STOPS.labels(model_id).inc()
+
+        return scanner.text[:scanner.end]
+
+    async def _ajudge_call(self, model_id: str, messages: list[dict], parameters: Parameters | dict) -> str:
+        """Sends the judge prompt, returning the raw verdict text."""
+        if self.streaming and JUDGE_STREAMING:
+            return await self._astream_judge_call(model_id=model_id, messages=messages, parameters=parameters)
+
+        judge_response = await self.achat(model_id=model_id, messages=messages, parameters=parameters)
+
+        return judge_response['content'] if 'content' in judge_response else ''
+
+    async def ajudge(self, judge: Judge, result: TestResult, parameters: Parameters | dict, cache: ResponseCache | CacheView | None = None) -> JudgeResponse:
+        messages = self._get_judge_messages(result=result)
+        parameters = self._get_judge_parameters(judge, parameters)
+
+        # Verdicts are keyed on the rendered prompt, so identical answers to the same test share a verdict
+        if cache is not None:
+            key = self._get_verdict_key(judge, messages, parameters)
+            verdict = await cache.aget(key)
+
+            if verdict is not None:
+                record_cache_hit()
+                return JudgeResponse(**verdict)
+
+        judge_response = await self._ajudge_call(model_id=judge.model_id, messages=messages, parameters=parameters)
+
+        verdict = self._parse_verdict(judge, judge_response)
+
+        if cache is not None and not verdict.parse_error:
+            await cache.aset(key, verdict.model_dump())
+
+        return verdict
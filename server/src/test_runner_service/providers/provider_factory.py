@@ -1,13 +1,32 @@
 from test_runner_service.schemas import ModelSource, Credentials
+from test_runner_service.constants import CASSETTE_MODE, CASSETTE_PATH
 from test_runner_service.providers.provider import Provider
 from test_runner_service.providers.watsonx import WatsonXProvider
 from test_runner_service.providers.ollama import OllamaProvider
+from test_runner_service.providers.cassette import get_cassette_recorder, get_cassette_player
+from test_runner_service.providers.recording import RecordingProvider, ReplayProvider
 
 class ProviderFactory:
     @staticmethod
     def create(       
         source: ModelSource,
         credentials: Credentials
+    ) -> Provider:
+        # Replays don't call the model, so they need neither the provider nor its credentials
+        if CASSETTE_MODE == 'replay':
+            return ReplayProvider(source=source, player=get_cassette_player(CASSETTE_PATH))
+
+        provider = ProviderFactory.create_provider(source=source, credentials=credentials)
+
+        if CASSETTE_MODE == 'record':
+            return RecordingProvider(provider=provider, recorder=get_cassette_recorder(CASSETTE_PATH))
+
+        return provider
+
+    @staticmethod
+    def create_provider(
+        source: ModelSource,
+        credentials: Credentials
     ) -> Provider:
         if source == 'ollama':
             return OllamaProvider()
@@ -17,4 +36,4 @@ class ProviderFactory:
                 project_id=credentials.watsonx_project_id
             )
         else:
-            raise Exception("Invalid 'source'")
\ No newline at end of file
+            raise Exception("Invalid 'source'")
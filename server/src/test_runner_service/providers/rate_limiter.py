@@ -0,0 +1,183 @@
+import asyncio
+import json
+import threading
+from time import monotonic, sleep
+
+from test_runner_service.constants import SOURCE_RATE_LIMITS, RATE_LIMIT_MIN_RPS, RATE_LIMIT_INCREASE, RATE_LIMIT_DECREASE
+from test_runner_service.schemas import Parameters
+from test_runner_service.utils import logger
+
+THROTTLING_STATUS_CODES = (429, 503)
+
+def get_status_code(error: Exception) -> int | None:
+    """HTTP status code of an OpenAI or WatsonX client error, if any."""
+    status_code = getattr(error, 'status_code', None)
+
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+
+    try:
+        return int(status_code) if status_code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def is_throttling_error(error: Exception) -> bool:
+    return get_status_code(error) in THROTTLING_STATUS_CODES
+
+def estimate_tokens(content: str | list | dict | None, parameters: Parameters | dict | None = None) -> int:
+    """Rough token count of a request (~4 characters per token) plus its completion budget."""
+    if isinstance(parameters, Parameters):
+        max_tokens = parameters.max_tokens
+    elif isinstance(parameters, dict):
+        max_tokens = parameters.get('max_tokens') or parameters.get('max_new_tokens')
+    else:
+        max_tokens = None
+
+    if content is not None and not isinstance(content, str):
+        content = json.dumps(content)
+
+    return len(content or '') // 4 + (max_tokens or 0)
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket for a provider endpoint, limiting requests per second and, optionally, tokens per minute.
+    The request rate follows AIMD: it grows by 'increase' after every successful call, up to 'max_rps',
+    and is multiplied by 'decrease' whenever the endpoint answers 429/503. 'None' disables a limit.
+
+    Callers reserve capacity before sending a request and wait for as long as the bucket is in debt,
+    so concurrent callers are served in order. Thread-safe, usable from sync and async code.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_rps: float | None,
+        max_tpm: float | None = None,
+        min_rps: float = RATE_LIMIT_MIN_RPS,
+        increase: float = RATE_LIMIT_INCREASE,
+        decrease: float = RATE_LIMIT_DECREASE
+    ):
+        self.name = name
+        self.max_rps = max_rps
+        self.max_tpm = max_tpm
+        self.min_rps = min(min_rps, max_rps) if max_rps else min_rps
+        self.increase = increase
+        self.decrease = decrease
+
+        self.__lock = threading.Lock()
+        self.__rps = max_rps
+        self.__requests = max(1.0, max_rps or 0)
+        self.__tokens = max_tpm or 0.0
+        self.__updated_at = monotonic()
+        self.__throttled = 0
+        self.__waiting = 0
+
+    def _refill(self, now: float):
+        elapsed = now - self.__updated_at
+        self.__updated_at = now
+
+        if self.max_rps:
+            self.__requests = min(max(1.0, self.__rps), self.__requests + elapsed * self.__rps)
+
+        if self.max_tpm:
+            self.__tokens = min(self.max_tpm, self.__tokens + elapsed * self.max_tpm / 60)
+
+    def _reserve(self, tokens: int) -> float:
+        """Takes one request and 'tokens' tokens from the buckets, returning how long the caller must wait."""
+        with self.__lock:
+            self._refill(monotonic())
+
+            wait = 0
+
+            if self.max_rps:
+                self.__requests -= 1
+                if self.__requests < 0:
+                    wait = -self.__requests / self.__rps
+
+            if self.max_tpm:
+                self.__tokens -= tokens
+                if self.__tokens < 0:
+                    wait = max(wait, -self.__tokens / (self.max_tpm / 60))
+
+            return wait
+
+    def acquire(self, tokens: int = 0):
+        wait = self._reserve(tokens)
+
+        if wait > 0:
+            self._track_waiting(1)
+            try:
+                sleep(wait)
+            finally:
+                self._track_waiting(-1)
+
+    async def aacquire(self, tokens: int = 0):
+        wait = self._reserve(tokens)
+
+        if wait > 0:
+            self._track_waiting(1)
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._track_waiting(-1)
+
+    def _track_waiting(self, delta: int):
+        with self.__lock:
+            self.__waiting += delta
+
+    def on_success(self, reserved_tokens: int = 0, used_tokens: int | None = None):
+        with self.__lock:
+            if self.max_rps:
+                self.__rps = min(self.max_rps, self.__rps + self.increase)
+
+        self.reconcile(reserved_tokens, used_tokens)
+
+    def reconcile(self, reserved_tokens: int, used_tokens: int | None):
+        """Gives back the part of a reservation that was not used. Without a reported usage, the reservation is kept"""
+        with self.__lock:
+            if self.max_tpm and used_tokens is not None:
+                self.__tokens = min(self.max_tpm, self.__tokens + reserved_tokens - used_tokens)
+
+    def on_throttle(self):
+        with self.__lock:
+            self.__throttled += 1
+
+            if not self.max_rps:
+                logger.warning(f"'{self.name}' is throttling requests.")
+                return
+
+            self.__rps = max(self.min_rps, self.__rps * self.decrease)
+            self.__requests = min(self.__requests, 0)
+            rps = self.__rps
+
+        logger.warning(f"'{self.name}' is throttling requests. Reducing rate to {rps:.2f} requests/s.")
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {
+                'name': self.name,
+                'rps': round(self.__rps, 3) if self.max_rps else None,
+                'max_rps': self.max_rps,
+                'max_tpm': self.max_tpm,
+                'available_tokens': round(self.__tokens) if self.max_tpm else None,
+                'throttled': self.__throttled,
+                'waiting': self.__waiting
+            }
+
+_limiters: dict[tuple[str, str], AdaptiveRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(source: str, model_id: str) -> AdaptiveRateLimiter:
+    """Returns the process-wide limiter of a provider source and model."""
+    with _limiters_lock:
+        key = (source, model_id)
+
+        if key not in _limiters:
+            limits = SOURCE_RATE_LIMITS.get(source, {})
+            _limiters[key] = AdaptiveRateLimiter(
+                name=f'{source}/{model_id}',
+                max_rps=limits.get('rps') or None,
+                max_tpm=limits.get('tpm') or None
+            )
+
+        return _limiters[key]
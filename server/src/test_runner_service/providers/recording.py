@@ -0,0 +1,122 @@
+from typing import Any
+
+from test_runner_service.schemas import Parameters, ModelSource
+from test_runner_service.cache import cache_key
+from test_runner_service.metrics import get_current_call, record_usage
+
+from .provider import Provider
+from .cassette import CassetteRecorder, CassettePlayer
+
+class CassetteMissError(Exception):
+    """Raised by 'ReplayProvider' for a request that is not in the cassette"""
+
+def get_request(kind: str, source: str, model_id: str, input: Any, parameters: Parameters | dict, tools: dict | None = None) -> dict:
+    return {
+        'kind': kind,
+        'source': source,
+        'model_id': model_id,
+        'input': input,
+        # Unset options are left out, so cassettes outlive new optional parameters
+        'parameters': parameters.model_dump(exclude_none=True) if isinstance(parameters, Parameters) else parameters,
+        'tools': tools
+    }
+
+def get_request_key(request: dict) -> str:
+    return cache_key(request['kind'], request['source'], request['model_id'], request['input'], request['parameters'], request['tools'])
+
+def get_usage() -> tuple[int | None, int | None]:
+    metrics = get_current_call()
+
+    if metrics is None:
+        return None, None
+
+    return metrics.prompt_tokens, metrics.completion_tokens
+
+class RecordingProvider(Provider):
+    """Calls 'provider' and appends every request with its response to a cassette, to be replayed by 'ReplayProvider'."""
+
+    def __init__(self, provider: Provider, recorder: CassetteRecorder):
+        self.provider = provider
+        self.recorder = recorder
+        self.source = provider.source
+
+    def _record(self, request: dict, response: Any, usage_before: tuple[int | None, int | None]):
+        # Usage of this call only: the current call metrics may already hold the usage of other calls
+        usage = tuple(
+            after - (before or 0) if after is not None else None
+            for before, after in zip(usage_before, get_usage())
+        )
+
+        self.recorder.record(get_request_key(request), request, response, usage)
+
+    def chat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None) -> dict:
+        usage_before = get_usage()
+        response = self.provider.chat(model_id=model_id, messages=messages, parameters=parameters, tools=tools)
+        self._record(get_request('chat', self.source, model_id, messages, parameters, tools), response, usage_before)
+
+        return response
+
+    def completions(self, model_id: str, prompt: str, parameters: Parameters) -> str:
+        usage_before = get_usage()
+        response = self.provider.completions(model_id=model_id, prompt=prompt, parameters=parameters)
+        self._record(get_request('completions', self.source, model_id, prompt, parameters), response, usage_before)
+
+        return response
+
+    # Records are small appends to a buffered file, so they are written from the event loop
+    async def achat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None) -> dict:
+        usage_before = get_usage()
+        response = await self.provider.achat(model_id=model_id, messages=messages, parameters=parameters, tools=tools)
+        self._record(get_request('chat', self.source, model_id, messages, parameters, tools), response, usage_before)
+
+        return response
+
+    async def acompletions(self, model_id: str, prompt: str, parameters: Parameters) -> str:
+        usage_before = get_usage()
+        response = await self.provider.acompletions(model_id=model_id, prompt=prompt, parameters=parameters)
+        self._record(get_request('completions', self.source, model_id, prompt, parameters), response, usage_before)
+
+        return response
+
+    async def _ajudge_call(self, model_id: str, messages: list[dict], parameters: Parameters | dict) -> str:
+        # The wrapped provider may send judge prompts its own way (e.g. streamed), so judge calls are recorded as such
+        usage_before = get_usage()
+        response = await self.provider._ajudge_call(model_id=model_id, messages=messages, parameters=parameters)
+        self._record(get_request('judge', self.source, model_id, messages, parameters), response, usage_before)
+
+        return response
+
+class ReplayProvider(Provider):
+    """
+    Serves the responses recorded by 'RecordingProvider' without calling the model.
+    Requests missing from the cassette fail with 'CassetteMissError'.
+    """
+
+    def __init__(self, source: ModelSource, player: CassettePlayer):
+        self.source = source
+        self.player = player
+
+    def _replay(self, request: dict) -> Any:
+        record = self.player.get(get_request_key(request))
+
+        if record is None:
+            raise CassetteMissError(f"No recorded {request['kind']} response of '{request['source']}/{request['model_id']}' in '{self.player.path}'")
+
+        record_usage(*record['usage'])
+
+        return record['response']
+
+    def chat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None) -> dict:
+        return self._replay(get_request('chat', self.source, model_id, messages, parameters, tools))
+
+    def completions(self, model_id: str, prompt: str, parameters: Parameters) -> str:
+        return self._replay(get_request('completions', self.source, model_id, prompt, parameters))
+
+    async def achat(self, model_id: str, messages: list[dict], parameters: Parameters, tools: dict | None = None) -> dict:
+        return self.chat(model_id=model_id, messages=messages, parameters=parameters, tools=tools)
+
+    async def acompletions(self, model_id: str, prompt: str, parameters: Parameters) -> str:
+        return self.completions(model_id=model_id, prompt=prompt, parameters=parameters)
+
+    async def _ajudge_call(self, model_id: str, messages: list[dict], parameters: Parameters | dict) -> str:
+        return self._replay(get_request('judge', self.source, model_id, messages, parameters))
@@ -0,0 +1,212 @@
+import asyncio
+import random
+import threading
+from time import monotonic, sleep
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+import openai
+
+from test_runner_service.constants import (
+    MAX_RETRY_ATTEMPS, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+    CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT
+)
+from test_runner_service.utils import logger
+from test_runner_service.metrics import record_retry
+
+from .rate_limiter import get_status_code, is_throttling_error
+
+T = TypeVar('T')
+
+RETRYABLE_STATUS_CODES = (408, 409, 425, 429, 500, 502, 503, 504)
+
+class CircuitOpenError(Exception):
+    pass
+
+class RetriesExceededError(Exception):
+    pass
+
+def is_retryable_error(error: Exception) -> bool:
+    """Network errors, timeouts, throttling and server errors are transient, anything else is not."""
+    if isinstance(error, CircuitOpenError):
+        return False
+
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+
+    return isinstance(error, (OSError, TimeoutError, asyncio.TimeoutError, httpx.TransportError, openai.APIConnectionError))
+
+class CircuitBreaker:
+    """
+    Fails fast once an endpoint fails 'failure_threshold' calls in a row. After 'reset_timeout' seconds
+    a single probe call is let through: its success closes the breaker, its failure opens it again.
+    A throttled or cancelled probe leaves the breaker half open, so the next call probes again.
+    Only transient errors other than throttling count as failures, since the endpoint answered the others. Thread-safe.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_BREAKER_THRESHOLD, reset_timeout: float = CIRCUIT_BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__opened_at: float | None = None
+        self.__probing = False
+
+    @property
+    def state(self) -> str:
+        with self.__lock:
+            return self._state(monotonic())
+
+    def _state(self, now: float) -> str:
+        if self.__opened_at is None:
+            return 'closed'
+
+        return 'half_open' if now - self.__opened_at >= self.reset_timeout else 'open'
+
+    def before_call(self) -> bool:
+        """Raises when the call must not be sent. Returns True when the call is the probe of the half open breaker"""
+        with self.__lock:
+            state = self._state(monotonic())
+
+            if state == 'open' or (state == 'half_open' and self.__probing):
+                raise CircuitOpenError(f"'{self.name}' is unavailable after {self.__failures} consecutive failures. Skipping the call.")
+
+            if state == 'half_open':
+                self.__probing = True
+                return True
+
+            return False
+
+    def release_probe(self):
+        """Lets the next call probe the endpoint, after a probe that neither succeeded nor failed"""
+        with self.__lock:
+            self.__probing = False
+
+    def on_success(self):
+        with self.__lock:
+            if self.__opened_at is not None:
+                logger.info(f"'{self.name}' is available again.")
+
+            self.__failures = 0
+            self.__opened_at = None
+            self.__probing = False
+
+    def on_failure(self):
+        with self.__lock:
+            self.__failures += 1
+            self.__probing = False
+
+            if self.__opened_at is not None or self.__failures >= self.failure_threshold:
+                if self.__opened_at is None:
+                    logger.error(f"'{self.name}' failed {self.__failures} consecutive calls. Failing fast for {self.reset_timeout} seconds.")
+
+                self.__opened_at = monotonic()
+
+    def record(self, error: Exception | None, probe: bool = False):
+        if error is None or not is_retryable_error(error):
+            self.on_success()
+        elif not is_throttling_error(error):
+            self.on_failure()
+        elif probe:
+            self.release_probe()
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return { 'name': self.name, 'state': self._state(monotonic()), 'failures': self.__failures }
+
+class RetryPolicy:
+    """
+    Retries a call on transient errors, up to 'max_retries' times, sleeping with exponential backoff
+    and full jitter between the attempts. State is scoped to a single call, so policies can be shared.
+    """
+
+    def __init__(self, max_retries: int = MAX_RETRY_ATTEMPS, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _handle_failure(self, e: Exception, attempt: int, breaker: CircuitBreaker | None, probe: bool = False) -> float:
+        """Returns how long to wait before the next attempt or raises if the call must not be retried."""
+        if breaker is not None:
+            breaker.record(e, probe)
+
+        if not is_retryable_error(e):
+            logger.error("Failed to generate model response: " + str(e))
+            raise e
+
+        if attempt >= self.max_retries:
+            err_message = f"Max number of retries ({self.max_retries}) exceeded. Error:\nFailed to generate model response: " + str(e)
+            logger.error(err_message)
+            raise RetriesExceededError(err_message) from e
+
+        delay = self.get_delay(attempt)
+        record_retry()
+
+        logger.error("Failed to generate model response: " + str(e))
+        logger.info(f"Retrying in {delay:.2f} seconds... ({attempt + 1}/{self.max_retries})")
+
+        return delay
+
+    def call(self, fn: Callable[[], T], breaker: CircuitBreaker | None = None) -> T:
+        attempt = 0
+
+        while True:
+            probe = breaker.before_call() if breaker is not None else False
+
+            try:
+                res = fn()
+            except Exception as e:
+                sleep(self._handle_failure(e, attempt, breaker, probe))
+                attempt += 1
+                continue
+            except BaseException:
+                if probe:
+                    breaker.release_probe()
+                raise
+
+            if breaker is not None:
+                breaker.record(None)
+
+            return res
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], breaker: CircuitBreaker | None = None) -> T:
+        attempt = 0
+
+        while True:
+            probe = breaker.before_call() if breaker is not None else False
+
+            try:
+                res = await fn()
+            except Exception as e:
+                await asyncio.sleep(self._handle_failure(e, attempt, breaker, probe))
+                attempt += 1
+                continue
+            except BaseException:
+                # A cancelled probe gets no outcome, the next call probes instead
+                if probe:
+                    breaker.release_probe()
+                raise
+
+            if breaker is not None:
+                breaker.record(None)
+
+            return res
+
+_breakers: dict[tuple[str, str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(source: str, model_id: str) -> CircuitBreaker:
+    """Returns the process-wide circuit breaker of a provider source and model."""
+    with _breakers_lock:
+        key = (source, model_id)
+
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(name=f'{source}/{model_id}')
+
+        return _breakers[key]
@@ -1,108 +1,134 @@
-from time import sleep
-
 from ibm_watsonx_ai.foundation_models import ModelInference
 from ibm_watsonx_ai.foundation_models.schema import TextChatParameters, TextGenParameters
 from ibm_watsonx_ai import Credentials as WXCredentials
 
 from test_runner_service.schemas import Parameters
-from test_runner_service.utils import logger
-from test_runner_service.constants import MAX_RETRY_ATTEMPS, RETRY_TIME
 
 from .provider import Provider
+from .clients import get_client, get_async_client
+from .rate_limiter import estimate_tokens
 
 ACCESS_TOKEN_URL="https://iam.cloud.ibm.com/identity/token"
 WX_URL="https://us-south.ml.cloud.ibm.com/"
 
 class WatsonXProvider(Provider):
+    source = 'watsonx'
+
+    __api_key: str
     __project_id: str
-    __current_retry_attempts: int
     __credentials: WXCredentials
 
     def __init__(self, api_key: str, project_id: str):
+        self.__api_key = api_key
         self.__project_id = project_id
-        self.__current_retry_attempts = 0
 
         self.__credentials = WXCredentials(
             url=WX_URL,
             api_key=api_key
         )
-    
+
+    def _create_model(self, model_id: str) -> ModelInference:
+        return ModelInference(
+            model_id=model_id,
+            credentials=self.__credentials,
+            project_id=self.__project_id,
+        )
+
+    def _get_model(self, model_id: str) -> ModelInference:
+        return get_client(('watsonx', model_id, self.__api_key, self.__project_id), lambda: self._create_model(model_id))
+
+    def _get_async_model(self, model_id: str) -> ModelInference:
+        return get_async_client(('watsonx', model_id, self.__api_key, self.__project_id), lambda: self._create_model(model_id))
+
+    def _get_token_usage(self, res: dict | list[dict]) -> tuple[int | None, int | None]:
+        if isinstance(res, list):
+            usages = [self._get_token_usage(r) for r in res]
+
+            if any(usage == (None, None) for usage in usages):
+                return None, None
+
+            return sum(p or 0 for p, _ in usages), sum(c or 0 for _, c in usages)
+
+        if 'usage' in res:
+            return res['usage'].get('prompt_tokens'), res['usage'].get('completion_tokens')
+
+        results = res.get('results') or [{}]
+        if 'generated_token_count' in results[0]:
+            return results[0].get('input_token_count', 0), results[0]['generated_token_count']
+
+        return None, None
+
     def chat(self, model_id: str, messages: list[dict], parameters: Parameters | dict, tools: dict | None = None):
-        try:
-            model = ModelInference(
-                model_id=model_id,
-                credentials=self.__credentials,
-                project_id=self.__project_id,
-            )
-
-            res = model.chat(
+        res = self._call(
+            model_id,
+            lambda: self._get_model(model_id).chat(
                 messages=messages,
                 tools=tools,
                 tool_choice_option="auto" if tools is not None else "none",
                 params=self._convert_parameters_to_chat_parameters(parameters=parameters)
-            )
-
-            return res['choices'][0]['message']
-        except Exception as e:
-            self.__current_retry_attempts += 1
-
-            if self.__current_retry_attempts > MAX_RETRY_ATTEMPS:
-                err_message = f"Max number of retries ({MAX_RETRY_ATTEMPS}) exceeded. Error:\nFailed to generate model response: " + str(e)
-                logger.error(err_message)
-                raise Exception(err_message)
-        
-            logger.error("Failed to generate model response: " + str(e))
-            logger.info(f"Retrying in {RETRY_TIME} seconds...")
-            sleep(RETRY_TIME)
+            ),
+            reserved_tokens=estimate_tokens(messages, parameters)
+        )
 
-            return self.chat(model_id=model_id, messages=messages, tools=tools, parameters=parameters)
+        return res['choices'][0]['message']
 
     def completions(self, model_id: str, prompt: str, parameters: Parameters | dict) -> str:
-        try:
-            model = ModelInference(
-                model_id=model_id,
-                credentials=self.__credentials,
-                project_id=self.__project_id,
-            )
-
-            res = model.generate(
+        res = self._call(
+            model_id,
+            lambda: self._get_model(model_id).generate(
                 prompt=prompt,
-                params=self._convert_parameters_to_completion_parameters(parameters=parameters)         
-            )
+                params=self._convert_parameters_to_completion_parameters(parameters=parameters)
+            ),
+            reserved_tokens=estimate_tokens(prompt, parameters)
+        )
+
+        return res['results'][0]['generated_text']
 
-            return res['results'][0]['generated_text']
-        except Exception as e:
-            self.__current_retry_attempts += 1
+    async def achat(self, model_id: str, messages: list[dict], parameters: Parameters | dict, tools: dict | None = None):
+        res = await self._acall(
+            model_id,
+            lambda: self._get_async_model(model_id).achat(
+                messages=messages,
+                tools=tools,
+                tool_choice_option="auto" if tools is not None else "none",
+                params=self._convert_parameters_to_chat_parameters(parameters=parameters)
+            ),
+            reserved_tokens=estimate_tokens(messages, parameters)
+        )
 
-            if self.__current_retry_attempts > MAX_RETRY_ATTEMPS:
-                err_message = f"Max number of retries ({MAX_RETRY_ATTEMPS}) exceeded. Error:\nFailed to generate model response: " + str(e)
-                logger.error(err_message)
-                raise Exception(err_message)
-        
-            logger.error("Failed to generate model response: " + str(e))
-            logger.info(f"Retrying in {RETRY_TIME} seconds...")
-            sleep(RETRY_TIME)
+        return res['choices'][0]['message']
 
-            return self.completions(model_id=model_id, prompt=prompt, parameters=parameters)
+    async def _agenerate(self, model_id: str, prompt: str, params: dict) -> dict:
+        return await self._acall(
+            model_id,
+            lambda: self._get_async_model(model_id).agenerate(prompt=prompt, params=params),
+            reserved_tokens=estimate_tokens(prompt, params)
+        )
+
+    async def acompletions(self, model_id: str, prompt: str, parameters: Parameters | dict) -> str:
+        res = await self._agenerate(model_id, prompt, self._convert_parameters_to_completion_parameters(parameters=parameters))
+
+        return res['results'][0]['generated_text']
 
     def _convert_parameters_to_chat_parameters(self, parameters: Parameters | dict) -> TextChatParameters:
         if isinstance(parameters, dict):
             return parameters
-        
+
         default_params = TextChatParameters(
             temperature=parameters.temperature,
             top_p=parameters.top_p,
             max_tokens=parameters.max_tokens,
             frequency_penalty=parameters.frequency_penalty,
-            presence_penalty=parameters.presence_penalty
+            presence_penalty=parameters.presence_penalty,
+            response_format=parameters.response_format
         ).to_dict()
 
         return { **default_params, **parameters.additional_params }
-    
+
     def _convert_parameters_to_completion_parameters(self, parameters: Parameters | dict) -> TextChatParameters:
         if isinstance(parameters, dict):
             return parameters
-        
+
         default_params = TextGenParameters(
             temperature=parameters.temperature,
             top_p=parameters.top_p,
@@ -112,10 +138,3 @@ class WatsonXProvider(Provider):
         ).to_dict()
 
         return { **default_params, **parameters.additional_params }
-
-
-
-
-
-
-
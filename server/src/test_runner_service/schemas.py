@@ -1,8 +1,8 @@
 from typing import Literal, Any
 from typing_extensions import Self
-from grafite.constants import DEFAULT_JUDGE_GUIDELINE
+from grafite.constants import DEFAULT_JUDGE_GUIDELINE, JUDGE_STRUCTURED_OUTPUT
 
-from pydantic import BaseModel, model_validator
+from pydantic import BaseModel, PrivateAttr, model_validator
 
 ModelSource = Literal["watsonx", "ollama"]
 
@@ -15,17 +15,54 @@ class Parameters(BaseModel):
     repetition_penalty: float = 1
     max_tokens: int = 1024
     additional_params: dict[str, Any] = {}
-    thinking: bool = None
+    thinking: bool | None = None
+    # OpenAI-style response format (e.g. '{"type": "json_object"}'), for the chat calls of providers supporting JSON output
+    response_format: dict[str, Any] | None = None
+
+class Concurrency(BaseModel):
+    # Number of concurrent model calls. 'None' falls back to the provider source default
+    generation: int | None = None
+    judging: int | None = None
 
 class Judge(BaseModel):
     source: ModelSource
     model_id: str 
     parameters: Parameters = Parameters()
+    # Maximum concurrent calls to this judge. 'None' falls back to the provider source default
+    max_concurrency: int | None = None
+    # Asks the judge for a JSON verdict through the 'response_format' of its chat calls
+    structured_output: bool = JUDGE_STRUCTURED_OUTPUT
+
+class Candidate(BaseModel):
+    """A model compared in a multi-model run"""
+    source: ModelSource
+    model_id: str
+    parameters: Parameters = Parameters()
+
+class CallMetrics(BaseModel):
+    """Measures of a generation or judge call, including its retries and rate limiter waits. Times are in seconds"""
+    wall_time: float | None = None
+    # Time to first token, only measured on streamed calls
+    ttft: float | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    retries: int = 0
+    rate_limit_wait: float = 0
+    # Set when the response came from a cache, without calling the provider
+    cached: bool = False
+    # Set when a streamed judge call was closed once its verdict was complete.
+    # Its 'completion_tokens' are then the tokens streamed until the verdict
+    early_stopped: bool = False
 
 class JudgeResponse(BaseModel):
     test_score: Literal[0, 1]
     test_justification: str
     model_id: str
+    # Set when the judge call failed, so the verdict can be redone when resuming the run
+    error: str | None = None
+    # Set when the judge output had no verdict JSON. The verdict is scored 0 and is not cached
+    parse_error: bool = False
+    metrics: CallMetrics | None = None
     
 class Credentials(BaseModel):
     watsonx_api_key: str | None = None
@@ -55,3 +92,9 @@ class TestResult(BaseModel):
     ground_truth: str | None = None
     model_response: str | None = None
     judge_results: list[JudgeResponse]
+    # Set when the model response could not be generated
+    error: str | None = None
+    metrics: CallMetrics | None = None
+
+    # 'messages' rendered for the judge prompts, shared by all the judges of the result
+    _transcript: str | None = PrivateAttr(default=None)
@@ -1,23 +1,55 @@
 import json
 import os
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import partial
+import asyncio
+from typing import AsyncIterator, Hashable
+from itertools import chain
+from time import monotonic
 from copy import deepcopy
 
-from test_runner_service.schemas import ModelSource, Credentials, Judge, TestResult, TestInput, Parameters, JudgeResponse
+from test_runner_service.schemas import ModelSource, Credentials, Judge, TestResult, TestInput, Parameters, JudgeResponse, Concurrency, CallMetrics
 from test_runner_service.providers.provider_factory import ProviderFactory
 from test_runner_service.providers.provider import Provider
-from test_runner_service.utils import logger, LOG_FORMATTER, get_current_iso_string
-from test_runner_service.constants import MAX_WORKERS
+from test_runner_service.providers.rate_limiter import get_rate_limiter
+from test_runner_service.providers.retry import get_circuit_breaker
+from test_runner_service.utils import logger, LOG_FORMATTER, get_current_iso_string, summarize_call_metrics
+from test_runner_service.metrics import record_call, record_cache_hit
+from test_runner_service.event_loop import run_coroutine
+from test_runner_service.cache import ResponseCache, CacheView, cache_key
+from test_runner_service.constants import MAX_WORKERS, SOURCE_MAX_WORKERS, PIPELINE_QUEUE_SIZE
+
+class PipelineLimits:
+    """
+    Semaphores bounding the generation and judging stages of a run. Runners sharing an instance
+    share one worker pool, e.g. the candidates of a comparison run. Each limit is the largest size
+    registered for it, and is fixed once its semaphore is first used.
+    """
+
+    def __init__(self):
+        self.__workers: dict[Hashable, int] = {}
+        self.__semaphores: dict[Hashable, asyncio.Semaphore] = {}
+
+    def register(self, key: Hashable, workers: int):
+        self.__workers[key] = max(self.__workers.get(key, 0), workers)
+
+    def get(self, key: Hashable) -> asyncio.Semaphore:
+        if key not in self.__semaphores:
+            self.__semaphores[key] = asyncio.Semaphore(self.__workers.get(key, MAX_WORKERS))
+
+        return self.__semaphores[key]
 
 class TestRunnerService:
     __model_id: str
     __source: ModelSource
     __tests: list[TestInput]
+    __results_to_judge: list[TestResult]
     __judges: list[Judge]
     __parameters: Parameters
     __credentials: Credentials
+    __concurrency: Concurrency
+    __response_cache: CacheView | None
+    __verdict_cache: CacheView | None
+    __limits: PipelineLimits | None
 
     def __init__(
         self, 
@@ -26,7 +58,12 @@ class TestRunnerService:
         credentials: Credentials,
         tests: list[TestInput],
         judges: list[Judge] = [],
+        results_to_judge: list[TestResult] = [],
         parameters: Parameters = Parameters(),
+        concurrency: Concurrency = Concurrency(),
+        response_cache: ResponseCache | None = None,
+        verdict_cache: ResponseCache | None = None,
+        limits: PipelineLimits | None = None,
         logs_dir_path: str | None = None
     ):    
         has_wx_judge = False
@@ -39,54 +76,92 @@ class TestRunnerService:
         
         if logs_dir_path is not None and not os.path.isdir(logs_dir_path):
             raise Exception("Invalid 'logs_dir_path'. Path does not exist")
+
+        if (concurrency.generation is not None and concurrency.generation < 1) or (concurrency.judging is not None and concurrency.judging < 1):
+            raise Exception("'concurrency.generation' and 'concurrency.judging' must be greater than 0")
          
         self.__model_id = model_id
         self.__source = source
         self.__tests = deepcopy(tests)
+        self.__results_to_judge = deepcopy(results_to_judge)
         self.__judges = judges
         self.__parameters = parameters
         self.__credentials = credentials
+        self.__concurrency = concurrency
+        self.__response_cache = response_cache.view() if response_cache is not None else None
+        self.__verdict_cache = verdict_cache.view() if verdict_cache is not None else None
+        self.__limits = limits
+
+        self.__cancelled = False
+        self.__started_at: float | None = None
+        self.__counters = {'generated': 0, 'judged': 0, 'errors': 0, 'judge_errors': 0, 'judge_parse_errors': 0}
+        self.__generation_metrics: list[CallMetrics] = []
+        self.__judge_metrics: dict[str, list[CallMetrics]] = {}
+
+        if limits is not None:
+            self._register_limits(limits)
 
         if logs_dir_path is not None:
             file_handler = logging.FileHandler(f'{logs_dir_path}/{get_current_iso_string()}-test-runner-service.log', mode='a')
             file_handler.setFormatter(LOG_FORMATTER)
             logger.addHandler(file_handler)
 
-    def _generate_response(self, test: TestInput, provider: Provider) -> TestResult:
+    async def _call_model(self, test: TestInput, provider: Provider) -> str:
+        if test.messages is not None and len(test.messages) > 0:
+            model_response = await provider.achat(model_id=self.__model_id, messages=test.messages, tools=test.tools, parameters=self.__parameters)
+
+            has_valid_content = 'content' in model_response and model_response['content'] is not None
+            has_valid_tool_calls = 'tool_calls' in model_response and model_response['tool_calls'] is not None
+
+            if has_valid_content:
+                return model_response['content']
+            elif has_valid_tool_calls:
+                return json.dumps(model_response['tool_calls'])
+
+            return ''
+
+        return await provider.acompletions(model_id=self.__model_id, prompt=test.prompt, parameters=self.__parameters)
+
+    async def _get_model_response(self, test: TestInput, provider: Provider) -> str:
+        if self.__response_cache is None:
+            return await self._call_model(test, provider)
+
+        key = cache_key('generation', self.__source, self.__model_id, test.messages, test.prompt, test.tools, self.__parameters.model_dump())
+
+        model_response = await self.__response_cache.aget(key)
+
+        if model_response is not None:
+            logger.info(f"Using cached model response for test '{test.test_id}'.")
+            record_cache_hit()
+            return model_response
+
+        # Failed calls raise before reaching the cache, so only real responses are stored
+        model_response = await self._call_model(test, provider)
+        await self.__response_cache.aset(key, model_response)
+
+        return model_response
+
+    async def _generate_response(self, test: TestInput, provider: Provider) -> TestResult:
         logger.info(f"Generating model response for test '{test.test_id}'.")
 
         model_response = ''
+        error = None
+        metrics = None
 
-        if test.messages is not None and len(test.messages) > 0:
-            try:
-                model_response = provider.chat(model_id=self.__model_id, messages=test.messages, tools=test.tools, parameters=self.__parameters)
-
-                has_valid_content = 'content' in model_response and model_response['content'] is not None
-                has_valid_tool_calls = 'tool_calls' in model_response and model_response['tool_calls'] is not None
-                
-                
-                if has_valid_content:
-                    model_response = model_response['content']
-                elif has_valid_tool_calls :
-                    model_response = json.dumps(model_response['tool_calls'])
-                else :
-                    model_response = ''
-                    
-
-            except Exception as e:
-                model_response = str(e)
-                
-        elif test.prompt:
-            logger.warning(f"Test '{test.test_id}' messages array is empty. Trying to use prompt.")
-            
-            try:
-                model_response = provider.completions(model_id=self.__model_id, model_inference_url=self.__model_inference_url, prompt=test.prompt, parameters=self.__parameters)
-            except Exception as e:
-                model_response = str(e)
+        if (test.messages is not None and len(test.messages) > 0) or test.prompt:
+            if test.messages is None or len(test.messages) == 0:
+                logger.warning(f"Test '{test.test_id}' messages array is empty. Trying to use prompt.")
+
+            with record_call() as metrics:
+                try:
+                    model_response = await self._get_model_response(test, provider)
+                except Exception as e:
+                    model_response = str(e)
+                    error = str(e)
         else:
             logger.warning(f"Test '{test.test_id}' does not have messages nor prompt.")
             model_response = 'Error: Test does not have messages nor prompt'
-
+            error = model_response
 
         return TestResult(
             prompt_text=test.prompt, 
@@ -96,69 +171,214 @@ class TestRunnerService:
             ground_truth=test.ground_truth,
             model_response=model_response,
             test_id=test.test_id,
-            judge_results=[]
+            judge_results=[],
+            error=error,
+            metrics=metrics
         )
     
-    def _judge_response(self, result: TestResult, providers: list[Provider], judges: list[Judge]) -> TestResult:
-        results = []
-
-        for i, provider in enumerate(providers):
-            judge = judges[i]
+    async def _run_judge(self, result: TestResult, provider: Provider, judge: Judge, limit: asyncio.Semaphore) -> JudgeResponse:
+        async with limit:
             logger.info(f"Generating '{judge.model_id}' judge evaluation for test '{result.test_id}'.")
 
-            try:
-                judge_response = provider.judge(judge=judge, result=result, parameters=judge.parameters)
-            except Exception as e:
-                judge_response = JudgeResponse(test_score=0, test_justification=str(e), model_id=judge.model_id)
+            with record_call() as metrics:
+                try:
+                    judge_response = await provider.ajudge(judge=judge, result=result, parameters=judge.parameters, cache=self.__verdict_cache)
+                except Exception as e:
+                    judge_response = JudgeResponse(test_score=0, test_justification=str(e), model_id=judge.model_id, error=str(e))
+
+            judge_response.metrics = metrics
 
             logger.info(f"Generated '{judge.model_id}' judge evaluation for test '{result.test_id}'.")
 
-            results.append(judge_response)
-        
-        result.judge_results = results
+        return judge_response
+
+    async def _judge_response(self, result: TestResult, providers: list[Provider], judges: list[Judge], limits: list[asyncio.Semaphore]) -> TestResult:
+        # All the judges of a test run concurrently, so a panel costs roughly one round trip per test.
+        # 'gather' keeps the order of 'judges', regardless of which judge answered first
+        result.judge_results = list(await asyncio.gather(*[
+            self._run_judge(result, provider, judges[i], limits[i])
+            for i, provider in enumerate(providers)
+        ]))
 
         return result
     
+    def _generation_workers(self) -> int:
+        if self.__concurrency.generation is not None:
+            return self.__concurrency.generation
+
+        return SOURCE_MAX_WORKERS.get(self.__source, MAX_WORKERS)
+
+    def _judge_workers(self, judge: Judge) -> int:
+        if judge.max_concurrency is not None:
+            return judge.max_concurrency
+
+        return SOURCE_MAX_WORKERS.get(judge.source, MAX_WORKERS)
+
+    def _judging_workers(self) -> int:
+        if self.__concurrency.judging is not None:
+            return self.__concurrency.judging
+
+        # Enough tests in the judging stage to keep the least restricted judge busy
+        return max([self._judge_workers(j) for j in self.__judges], default=MAX_WORKERS)
+
+    def _register_limits(self, limits: PipelineLimits):
+        limits.register('generation', self._generation_workers())
+        limits.register('judging', self._judging_workers())
+
+        for judge in self.__judges:
+            limits.register(('judge', judge.source, judge.model_id), self._judge_workers(judge))
+
     def details(self):
         return {
             'model_id': self.__model_id,
             'judge_model_ids': [j.model_id for j in self.__judges],
-            'source': self.__source
+            'judges': [j.model_dump() for j in self.__judges],
+            'source': self.__source,
+            'concurrency': {
+                'generation': self._generation_workers(),
+                'judging': self._judging_workers(),
+                'judges': [self._judge_workers(j) for j in self.__judges]
+            }
         }
     
-    def run(self):
+    def stats(self, metrics: bool = True) -> dict:
+        """
+        Counters of the current run, saved on the run document once it finishes. The call 'metrics' sort every call
+        of the run, so the periodic saves leave them out. Not thread-safe, must be called from the event loop of the run or once it is over.
+        """
+        stats = {}
+
+        if self.__response_cache is not None:
+            stats['response_cache'] = self.__response_cache.stats()
+
+        if self.__verdict_cache is not None:
+            stats['judge_cache'] = self.__verdict_cache.stats()
+
+        # Limiters and breakers are shared by all the runs of the process, so this is the state of the endpoints when the run ends
+        endpoints = dict.fromkeys([(self.__source, self.__model_id), *((j.source, j.model_id) for j in self.__judges)])
+        stats['rate_limits'] = [get_rate_limiter(source, model_id).snapshot() for source, model_id in endpoints]
+        stats['circuit_breakers'] = [get_circuit_breaker(source, model_id).snapshot() for source, model_id in endpoints]
+
+        if not metrics:
+            return stats
+
+        # Calls made by this runner only, a resumed run or a shard does not include the previous ones
+        stats['metrics'] = {
+            'generation': summarize_call_metrics(self.__generation_metrics),
+            'judges': { model_id: summarize_call_metrics(metrics) for model_id, metrics in self.__judge_metrics.items() }
+        }
+
+        return stats
+
+    def cancel(self):
+        """Stops starting new tests. The tests in flight still finish and are yielded."""
+        self.__cancelled = True
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__cancelled
+
+    def progress(self) -> dict:
+        """Tests generated and judged so far by this runner, with the throughput in tests per second and the ETA in seconds."""
+        total = len(self.__tests) + len(self.__results_to_judge)
+        elapsed = monotonic() - self.__started_at if self.__started_at is not None else 0
+        throughput = self.__counters['judged'] / elapsed if elapsed > 0 else 0
+
+        return {
+            **self.__counters,
+            'throughput': round(throughput, 3),
+            'eta': round((total - self.__counters['judged']) / throughput, 1) if throughput > 0 and not self.__cancelled else None
+        }
+
+    async def aiter_results(self) -> AsyncIterator[TestResult]:
+        """
+        Streams the tests through generation and judging, yielding each result as soon as it is judged.
+        'results_to_judge' skip the generation. At most 'generation + judging + PIPELINE_QUEUE_SIZE'
+        tests are in flight at any time. No test is started once the runner is cancelled.
+        """
         provider: Provider = ProviderFactory.create(source=self.__source, credentials=self.__credentials)
+        judge_providers: list[Provider] = [ProviderFactory.create(source=judge.source, credentials=self.__credentials) for judge in self.__judges]
 
-        results: list[TestResult] = []
+        total = len(self.__tests) + len(self.__results_to_judge)
+        limits = self.__limits
 
-        worker = partial(self._generate_response, provider=provider)
+        if limits is None:
+            limits = PipelineLimits()
+            self._register_limits(limits)
 
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(worker, item) for item in self.__tests]
+        generation_limit = limits.get('generation')
+        judging_limit = limits.get('judging')
+        judge_limits = [limits.get(('judge', j.source, j.model_id)) for j in self.__judges]
+        max_in_flight = self._generation_workers() + self._judging_workers() + PIPELINE_QUEUE_SIZE
 
-            for future in as_completed(futures):
-                result = future.result()
-                results.append(result)
+        async def process(item: TestInput | TestResult) -> TestResult:
+            if isinstance(item, TestResult):
+                result = item
+            else:
+                async with generation_limit:
+                    result = await self._generate_response(item, provider=provider)
 
-                logger.info(f"Generated model response for test '{result.test_id}'. ({len(results)}/{len(self.__tests)})")
+                self.__counters['generated'] += 1
+                self.__counters['errors'] += int(result.error is not None)
 
-        if len(self.__judges) > 0:
-            judged_results: list[TestResult] = []
+                if result.metrics is not None:
+                    self.__generation_metrics.append(result.metrics)
 
-            judge_providers: list[Provider] = [ProviderFactory.create(source=judge.source, credentials=self.__credentials) for judge in self.__judges]
+                logger.info(f"Generated model response for test '{result.test_id}'.")
 
-            worker = partial(self._judge_response, providers=judge_providers, judges=self.__judges)
+            if len(self.__judges) > 0:
+                async with judging_limit:
+                    result = await self._judge_response(result, providers=judge_providers, judges=self.__judges, limits=judge_limits)
 
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                futures = [executor.submit(worker, item) for item in results]
+                self.__counters['judge_errors'] += int(any(j.error is not None for j in result.judge_results))
+                self.__counters['judge_parse_errors'] += sum(1 for j in result.judge_results if j.parse_error)
 
-                for future in as_completed(futures):
-                    judge_result = future.result()
-                    judged_results.append(judge_result)
+                for judge_result in result.judge_results:
+                    if judge_result.metrics is not None:
+                        self.__judge_metrics.setdefault(judge_result.model_id, []).append(judge_result.metrics)
 
-                    logger.info(f"Generated judge evaluation(s) for test '{judge_result.test_id}'. ({len(judged_results)}/{len(self.__tests)})")
-        
-        return judged_results if len(self.__judges) > 0 else results
+            self.__counters['judged'] += 1
+
+            return result
+
+        items = chain(self.__results_to_judge, self.__tests)
+        pending: set[asyncio.Task] = set()
+
+        def submit_next():
+            if self.__cancelled:
+                return
+
+            item = next(items, None)
+
+            if item is not None:
+                pending.add(asyncio.create_task(process(item)))
+
+        self.__started_at = monotonic()
+
+        for _ in range(max_in_flight):
+            submit_next()
+
+        done_count = 0
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    result = task.result()
+                    done_count += 1
+
+                    logger.info(f"Finished test '{result.test_id}'. ({done_count}/{total})")
+
+                    yield result
+
+                    submit_next()
+        finally:
+            for task in pending:
+                task.cancel()
 
+    async def arun(self) -> list[TestResult]:
+        return [result async for result in self.aiter_results()]
 
-        
\ No newline at end of file
+    def run(self) -> list[TestResult]:
+        # Runs on the process-wide event loop so provider clients are reused across runs
+        return run_coroutine(self.arun())
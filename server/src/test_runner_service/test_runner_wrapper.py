@@ -1,8 +1,15 @@
 import os
 import json
+import asyncio
+import threading
+from time import monotonic
 from typing import Union, Literal
 from datetime import datetime, timezone
-from test_runner_service import TestRunnerService, Parameters
+from pymongo.errors import BulkWriteError
+from test_runner_service import TestRunnerService, Parameters, TestResult
+from test_runner_service.event_loop import run_coroutine
+from test_runner_service.constants import RESULTS_FLUSH_BATCH_SIZE, RESULTS_FLUSH_INTERVAL, PROGRESS_INTERVAL
+from test_runner_service.utils import logger, get_run_id
 from grafite.db.mongodb import Mongo
 from grafite.constants import JUDGE_SYSTEM_PROMPT
 
@@ -25,18 +32,33 @@ class TestRunnerWrapper:
         number_of_tests: int,
         run_params: dict,
         tests: Union[list[str], Literal["*"]] = "*",
+        run_id: str | None = None,
+        completed_results: int = 0,
+        shard: int | None = None,
+        human_judge_results: dict[str, list[dict]] | None = None,
     ):
         now = datetime.now(timezone.utc)
-        date = now.strftime("%Y%m%d%H%M%S")
         
         self.__created_at = now.strftime('%Y-%m-%d %H:%M')
-        self.run_id = f'run_{date}'
+        # An existing 'run_id' resumes that run, 'completed_results' being the results it already has
+        self.run_id = run_id or get_run_id(now)
         self.__creator = creator
         self.__tests = tests
         self.__test_runner = test_runner
         self.__number_of_tests = number_of_tests
         self.__run_params = run_params
         self.db = db
+
+        self.__results_db = None
+        self.__pending_results: list[dict] = []
+        self.__completed_results = completed_results
+        # Ids of the results written by this wrapper, so a batch saved again after a failure is not counted twice
+        self.__saved_ids: set[str] = set()
+        # Shards of a run save to the same collection, so progress is counted from it instead of per wrapper
+        self.__shard = shard
+        self.__flush_lock = threading.Lock()
+        # Human annotations of the results judged again, by test id, added back to their new verdicts
+        self.__human_judge_results = human_judge_results or {}
         
         self.__run_params['additional_judge_system_prompt'] = JUDGE_SYSTEM_PROMPT
         
@@ -48,19 +70,161 @@ class TestRunnerWrapper:
             **(self.__test_runner.details()),
             "number_of_tests": self.__number_of_tests,
             "created_at": self.__created_at,
-            "config": self.__run_params
+            "config": self.__run_params,
+            "progress": self.get_progress()
         }
 
         return run_details
-    
-    def execute_tests(self):        
-        results = [r.model_dump() for r in self.__test_runner.run()]
 
-        return results
-    
+    def get_stats(self, metrics: bool = True):
+        return self.__test_runner.stats(metrics=metrics)
+
+    def get_progress(self):
+        return {"completed": self.get_saved_results(), "total": self.__number_of_tests, **self.__test_runner.progress()}
+
+    def get_saved_results(self) -> int:
+        return self.__completed_results + len(self.__saved_ids)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__test_runner.cancelled
+
+    def check_progress(self):
+        """Publishes the progress of the run on its document, and cancels the runner once the run has 'cancel_requested'."""
+        runs = self.db.run.get(match={"run_id": self.run_id}, fields={"cancel_requested": 1})
+
+        if len(runs) > 0 and runs[0].get("cancel_requested") and not self.cancelled:
+            logger.info(f"Cancelling '{self.run_id}'")
+            self.__test_runner.cancel()
+
+        # Shards of a run report their own progress, the run one is counted from the saved results
+        if self.__shard is not None:
+            self.db.run.update(filter={"run_id": self.run_id}, element={f"shards.progress.{self.__shard}": self.__test_runner.progress()})
+        else:
+            self.db.run.update(filter={"run_id": self.run_id}, element={"progress": self.get_progress()})
+
+    async def _acheck_progress(self):
+        try:
+            await asyncio.to_thread(self.check_progress)
+        except Exception as e:
+            # Progress events are best effort, the results are still saved
+            logger.warning(f"Failed to publish the progress of '{self.run_id}': {e}")
     
+    async def aexecute_tests(self):
+        last_flush = monotonic()
+
+        async def monitor():
+            nonlocal last_flush
+
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                await self._acheck_progress()
+
+                if monotonic() - last_flush >= RESULTS_FLUSH_INTERVAL:
+                    try:
+                        await self._aflush()
+                    except Exception as e:
+                        # The batch is kept, so the next flush saves it
+                        logger.warning(f"Failed to save the results of '{self.run_id}': {e}")
+
+                    last_flush = monotonic()
+
+        def log_monitor_failure(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"Progress and flush monitor of '{self.run_id}' stopped: {task.exception()!r}")
+
+        # A run cancelled before it starts does not start any test
+        await self._acheck_progress()
+
+        flusher = asyncio.create_task(monitor())
+        flusher.add_done_callback(log_monitor_failure)
+
+        try:
+            async for result in self.__test_runner.aiter_results():
+                self.__pending_results.append(self._get_document(result))
+
+                if len(self.__pending_results) >= RESULTS_FLUSH_BATCH_SIZE:
+                    await self._aflush()
+                    last_flush = monotonic()
+        finally:
+            flusher.cancel()
+
+        await self._aflush(final=True)
+        await self._acheck_progress()
+
+    def _get_document(self, result: TestResult) -> dict:
+        document = result.model_dump()
+        document['judge_results'] += self.__human_judge_results.get(result.test_id, [])
+
+        return document
+
+    async def _aflush(self, final: bool = False):
+        # The batch is taken on the event loop, so results appended while it is being saved go to the next one
+        results, self.__pending_results = self.__pending_results, []
+        # So are the stats, which the runner updates from the loop. The call metrics are only summarized once the run is over
+        stats = self.get_stats(metrics=final) if self.__shard is None and len(results) > 0 else None
+
+        try:
+            await asyncio.to_thread(self._save_results, results, stats)
+        except Exception:
+            # Keep the batch so a later flush can save it
+            self.__pending_results = results + self.__pending_results
+            raise
+
+    def execute_tests(self) -> int:
+        """Runs the tests, saving the results in batches as they complete. Returns the number of saved results."""
+        run_coroutine(self.aexecute_tests())
+
+        return self.get_saved_results()
+
+    def flush(self):
+        """Saves the pending results and updates the progress of the run."""
+        results, self.__pending_results = self.__pending_results, []
+        stats = self.get_stats() if self.__shard is None and len(results) > 0 else None
+
+        try:
+            self._save_results(results, stats)
+        except Exception:
+            self.__pending_results = results + self.__pending_results
+            raise
+
+    def _save_results(self, results: list[dict], stats: dict | None = None):
+        if len(results) == 0:
+            return
+
+        with self.__flush_lock:
+            if self.__results_db is None:
+                self.__results_db = self.db._get_interface_instance(self.run_id)
+                self.__results_db.collection.create_index('test_id')
+
+            # Upserting on 'test_id' makes a retried flush idempotent. The results are counted from the outcome
+            # of the bulk write, since the writes that succeeded before a failure are kept
+            try:
+                self.__results_db.bulk_upsert(key='test_id', values=results)
+            except BulkWriteError as e:
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                self.__saved_ids.update(r['test_id'] for i, r in enumerate(results) if i not in failed)
+                raise
+
+            self.__saved_ids.update(r['test_id'] for r in results)
+
+            logger.info(f"Saved {len(results)} results of '{self.run_id}'. ({self.get_saved_results()}/{self.__number_of_tests})")
+
+            if self.__shard is not None:
+                self.db.run.update(
+                    filter={"run_id": self.run_id},
+                    element={"progress.completed": self.__results_db.count_documents()}
+                )
+                return
+
+            self.db.run.update(
+                filter={"run_id": self.run_id},
+                element={"progress": self.get_progress(), **(stats or {})}
+            )
+
     def load_to_db(self, results: list[dict]):
         try:
-            self.db.save_new_collection(self.run_id, results)
+            self.__pending_results.extend(results)
+            self.flush()
         except Exception as e:
-            print(str(e))
\ No newline at end of file
+            print(str(e))
@@ -1,79 +1,271 @@
 import re
 import json
 import logging
+import math
+import secrets
+from functools import lru_cache
+from typing import Any
 from datetime import datetime, timezone
 
-from test_runner_service.schemas import TestResult, JudgeResponse
+from pydantic import BaseModel
 
-def extract_json_object(input_string):
-    # Remove markdown code block markers (```json or ```)
-    # Handle both single-line and multi-line code blocks
-    if "```" in input_string:
-        input_string = re.sub(r"^```(?:json|JSON)?\s*\n?", "", input_string, flags=re.MULTILINE)
-        input_string = re.sub(r"\n?```\s*$", "", input_string, flags=re.MULTILINE)
-        input_string = input_string.strip()
+from test_runner_service.schemas import TestResult, JudgeResponse, CallMetrics
 
+# Characters that change the state of the JSON object scanner, the others are skipped
+JSON_TOKEN_PATTERN = re.compile(r'[{}"\\]')
+
+# Candidate objects parsed per streamed judge output, as their closing braces arrive
+MAX_JSON_CANDIDATES = 64
+
+# Characters decoded per character of a whole judge output, over all its candidate objects
+JSON_DECODE_BUDGET = 64
+
+JSON_DECODER = json.JSONDecoder()
+
+class JsonObjectScanner:
+    """
+    Finds the balanced '{...}' spans of a text fed chunk by chunk, one candidate object at a time.
+    Quotes only start JSON strings inside a candidate, so quotes in the prose before it do not hide it.
+    A candidate that does not parse is dropped with 'restart', and the scan resumes inside it.
+    """
+
+    def __init__(self):
+        self.text = ""
+
+        self.__position = 0
+        self.__start: int | None = None
+        self.__depth = 0
+        self.__in_string = False
+        self.__escaped_until = -1
+
+    def feed(self, chunk: str) -> tuple[int, int] | None:
+        """Adds a chunk of the text, returning the start and end of the first candidate it closes"""
+        self.text += chunk
+
+        return self.scan()
+
+    def scan(self) -> tuple[int, int] | None:
+        """Start and end of the next candidate closed in the text, the scan resuming after it"""
+        for match in JSON_TOKEN_PATTERN.finditer(self.text, self.__position):
+            i = match.start()
+            char = self.text[i]
+
+            if i < self.__escaped_until or self.__start is None and char != '{':
+                continue
+
+            if self.__in_string:
+                if char == '\\':
+                    self.__escaped_until = i + 2
+                elif char == '"':
+                    self.__in_string = False
+            elif char == '"':
+                self.__in_string = True
+            elif char == '{':
+                if self.__start is None:
+                    self.__start = i
+
+                self.__depth += 1
+            elif char == '}':
+                self.__depth -= 1
+
+                if self.__depth == 0:
+                    span = (self.__start, i + 1)
+                    self.__position = i + 1
+                    self.__start = None
+
+                    return span
+
+        self.__position = len(self.text)
+
+        return None
+
+    def restart(self, position: int):
+        """Drops the current candidate, the next scan starting at 'position'"""
+        self.__position = position
+        self.__start = None
+        self.__depth = 0
+        self.__in_string = False
+        self.__escaped_until = -1
+
+def find_verdict_object(value: Any) -> dict | None:
+    """'value' itself or the first object nested in it with a 'justification' and a 'score'"""
+    pending = [value]
+
+    for item in pending:
+        if isinstance(item, dict):
+            if "justification" in item and "score" in item:
+                return item
+
+            pending.extend(item.values())
+        elif isinstance(item, list):
+            pending.extend(item)
+
+    return None
+
+def extract_verdict(text: str) -> dict | None:
+    """Verdict object of a judge output: the whole output when it is JSON, else the first JSON object holding a verdict"""
     try:
-        parsed = json.loads(input_string)
-        if "justification" in parsed and "score" in parsed:
-            return input_string
-    except json.JSONDecodeError:
+        verdict = find_verdict_object(json.loads(text))
+
+        if verdict is not None:
+            return verdict
+    except (json.JSONDecodeError, RecursionError):
         pass
 
-    # If that fails, try to find JSON object with justification and score using regex
-    # This pattern looks for a JSON object, handling escaped quotes and nested content
-    # Search for opening matching brace, then any content until finds both justification and score keys
+    # Each '{' starts a candidate object, decoded up to its closing brace. A candidate that doesn't parse
+    # (e.g. a stray brace in the prose) is dropped at its error, one that parses is not searched again
+    budget = JSON_DECODE_BUDGET * len(text)
+    start = text.find('{')
+
+    while start != -1 and budget > 0:
+        try:
+            value, end = JSON_DECODER.raw_decode(text, start)
+        except json.JSONDecodeError as e:
+            # The error locates itself by counting the lines from the start of the text
+            budget -= e.pos + 1
+            start = text.find('{', start + 1)
+            continue
+        except RecursionError:
+            budget -= len(text) - start
+            start = text.find('{', start + 1)
+            continue
+
+        budget -= end - start
+        verdict = find_verdict_object(value)
+
+        if verdict is not None:
+            return verdict
+
+        start = text.find('{', end)
+
+    return None
+
+def is_valid_verdict(verdict: dict) -> bool:
+    return verdict["score"] in (0, 1) and isinstance(verdict["justification"], str)
+
+class VerdictScanner:
+    """
+    Parses a streamed judge output as it arrives, until it holds a complete and valid verdict object.
+    Each object is parsed when its closing brace arrives, and at most MAX_JSON_CANDIDATES of them are parsed.
+    """
+
+    def __init__(self):
+        self.verdict: dict | None = None
+        # End of the verdict object in 'text'
+        self.end: int | None = None
+
+        self.__scanner = JsonObjectScanner()
+        self.__attempts = 0
+
+    @property
+    def text(self) -> str:
+        return self.__scanner.text
 
-    # pattern = r'\{.*?"justification":\s*"[^"]*",\s*"score":\s*\d+[^\}]*\}'
-    pattern = r'\{(?:[^{}]|(?:\{[^{}]*\}))*"justification"\s*:\s*"(?:[^"\\]|\\.)*"\s*,\s*"score"\s*:\s*\d+(?:[^{}]|(?:\{[^{}]*\}))*\}'
+    def feed(self, chunk: str) -> dict | None:
+        """Adds a chunk of the output, returning the verdict once it is complete"""
+        if self.verdict is not None:
+            return self.verdict
 
-    matches = re.findall(pattern, input_string, re.DOTALL | re.IGNORECASE)
+        span = self.__scanner.feed(chunk)
+
+        # A verdict after a stray brace of the prose is only found by 'extract_verdict', once the stream is over
+        while span is not None and self.__attempts < MAX_JSON_CANDIDATES:
+            self.__attempts += 1
+            start, end = span
 
-    if matches:
-        for match in matches:
             try:
-                parsed = json.loads(match)
-                if "justification" in parsed and "score" in parsed:
-                    return match
-            except json.JSONDecodeError:
+                verdict = find_verdict_object(json.loads(self.text[start:end]))
+            except (json.JSONDecodeError, RecursionError):
+                self.__scanner.restart(start + 1)
+                span = self.__scanner.scan()
                 continue
 
-    return input_string
+            if verdict is not None and is_valid_verdict(verdict):
+                self.verdict = verdict
+                self.end = end
+                return verdict
+
+            span = self.__scanner.scan()
+
+        return None
 
 def post_process_judge_response(resp_str: str, model_id: str):
-    resp_dict_str = extract_json_object(resp_str.strip())
-    
-    try:
-        resp_dict = json.loads(resp_dict_str.strip())
-        score = resp_dict["score"]
-        justification = resp_dict["justification"]
-    except Exception as e:
-        score = 0
-        justification = (
-            f'Parsing error in the judge response string "{resp_str}".\nError "{e}"'
+    verdict = extract_verdict(resp_str.strip())
+
+    if verdict is None:
+        return JudgeResponse(
+            test_score=0,
+            test_justification=f'Parsing error in the judge response string "{resp_str}".\nError "No JSON object with a \'justification\' and a \'score\'"',
+            model_id=model_id,
+            parse_error=True
         )
 
-    return JudgeResponse(test_score=score, test_justification=justification, model_id=model_id)
+    return JudgeResponse(test_score=verdict["score"], test_justification=verdict["justification"], model_id=model_id)
+
+# '{{field}}' placeholders of the judge templates, filled with the 'TestResult' field of the same name
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+@lru_cache(maxsize=256)
+def compile_judge_template(template: str) -> tuple[tuple[str, str | None], ...]:
+    """
+    Splits a judge template into (text, field) segments, rendered as the text followed by the value of the field.
+    Placeholders that are not 'TestResult' fields are kept as text. The field of the last segment is None.
+    """
+    segments = []
+    text = ""
+
+    for i, part in enumerate(PLACEHOLDER_PATTERN.split(template)):
+        if i % 2 == 0:
+            text += part
+        elif part in TestResult.model_fields:
+            segments.append((text, part))
+            text = ""
+        else:
+            text += "{{" + part + "}}"
+
+    segments.append((text, None))
+
+    return tuple(segments)
+
+def get_transcript(result: TestResult) -> str:
+    """'role: content' lines of the result messages, rendered once per result"""
+    if result._transcript is None:
+        result._transcript = "\n".join(f"{m['role']}: {m['content']}" for m in result.messages)
+
+    return result._transcript
+
+def get_placeholder_value(result: TestResult, field: str) -> str | None:
+    """Text of a placeholder, None when it is kept as is"""
+    if field == 'prompt_text' and not result.prompt_text:
+        # Chat tests have no prompt, their messages are shown instead
+        return get_transcript(result) if result.messages is not None else None
+
+    value = getattr(result, field)
+
+    # Nested models are shown the way they are serialized
+    if isinstance(value, (BaseModel, list, dict)):
+        value = result.model_dump(include={field})[field]
+
+    return str(value)
 
 def get_judge_prompt(result: TestResult) -> str:
-    judge_prompt = str(result.judge_prompt)
+    if result.judge_prompt is None:
+        return "None"
 
-    result_as_dict = result.model_dump()
-    for td_k, td_v in result_as_dict.items():
-        inp_key = "{{" + td_k + "}}"
-        if inp_key in judge_prompt:
-            if td_k == 'prompt_text' and not result.prompt_text:
-                continue
+    parts = []
 
-            judge_prompt = judge_prompt.replace(inp_key, str(td_v))
-        if td_k == 'messages' and not result.prompt_text:
-            prompt_from_messages = "\n".join(
-                f"{m['role']}: {m['content']}" for m in result.messages
-            )
-            
-            judge_prompt = judge_prompt.replace('{{prompt_text}}', prompt_from_messages)
+    for text, field in compile_judge_template(result.judge_prompt):
+        parts.append(text)
 
-    return judge_prompt
+        if field is not None:
+            value = get_placeholder_value(result, field)
+            parts.append(value if value is not None else "{{" + field + "}}")
+
+    return "".join(parts)
+
+def get_run_id(now: datetime) -> str:
+    # Listeners process several runs at once, so the timestamp alone is not unique
+    return f'run_{now.strftime("%Y%m%d%H%M%S")}_{secrets.token_hex(3)}'
 
 def get_current_iso_string() -> str:
     current_utc_datetime = datetime.now(timezone.utc)
@@ -92,4 +284,83 @@ logger.setLevel(level="INFO")
 _stream_handler = logging.StreamHandler()
 
 _stream_handler.setFormatter(LOG_FORMATTER)
-logger.addHandler(_stream_handler)
\ No newline at end of file
+logger.addHandler(_stream_handler)
+
+def summarize_results(results: list[TestResult]) -> dict:
+    """Mean judge score of a run, overall and per judge, with its error counts. Failed calls are not scored, unparsable verdicts score 0."""
+    scores: list[int] = []
+    judge_scores: dict[str, list[int]] = {}
+    judge_errors = 0
+    parse_errors = 0
+
+    for result in results:
+        if result.error is not None:
+            continue
+
+        for judge_result in result.judge_results:
+            if judge_result.error is not None:
+                judge_errors += 1
+                continue
+
+            parse_errors += int(judge_result.parse_error)
+            scores.append(judge_result.test_score)
+            judge_scores.setdefault(judge_result.model_id, []).append(judge_result.test_score)
+
+    return {
+        'number_of_results': len(results),
+        'errors': sum(1 for r in results if r.error is not None),
+        'judge_errors': judge_errors,
+        'judge_parse_errors': parse_errors,
+        'judge_parse_error_rate': parse_errors / len(scores) if len(scores) > 0 else None,
+        'score': sum(scores) / len(scores) if len(scores) > 0 else None,
+        'judge_scores': { model_id: sum(s) / len(s) for model_id, s in judge_scores.items() }
+    }
+
+def percentiles(values: list[float]) -> dict | None:
+    """p50, p95, p99 and max of 'values' (nearest rank)"""
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    return { 'p50': rank(50), 'p95': rank(95), 'p99': rank(99), 'max': values[-1] }
+
+def summarize_call_metrics(metrics: list[CallMetrics]) -> dict:
+    """Latency percentiles, token counts and generation speed of a set of calls. Cached calls are only counted."""
+    calls = [m for m in metrics if not m.cached]
+    completion_tokens = sum(m.completion_tokens or 0 for m in calls)
+    # Speed is measured on the calls reporting their usage, so it is not diluted by the others
+    timed_calls = [m for m in calls if m.completion_tokens is not None and m.wall_time]
+    timed_time = sum(m.wall_time for m in timed_calls)
+
+    return {
+        'calls': len(metrics),
+        'cached': len(metrics) - len(calls),
+        'retries': sum(m.retries for m in calls),
+        'wall_time': percentiles([m.wall_time for m in calls if m.wall_time is not None]),
+        'ttft': percentiles([m.ttft for m in calls if m.ttft is not None]),
+        'rate_limit_wait': round(sum(m.rate_limit_wait for m in calls), 4),
+        # Streamed judge calls stopped once their verdict was complete
+        'early_stops': sum(1 for m in calls if m.early_stopped),
+        'early_stop_completion_tokens': sum(m.completion_tokens or 0 for m in calls if m.early_stopped),
+        'prompt_tokens': sum(m.prompt_tokens or 0 for m in calls),
+        'completion_tokens': completion_tokens,
+        'tokens_per_second': round(sum(m.completion_tokens for m in timed_calls) / timed_time, 2) if timed_time > 0 else None
+    }
+
+def summarize_metrics(results: list[TestResult]) -> dict:
+    """Call metrics of the generation and of each judge, over the stored results of a run"""
+    judge_metrics: dict[str, list[CallMetrics]] = {}
+
+    for result in results:
+        for judge_result in result.judge_results:
+            if judge_result.metrics is not None:
+                judge_metrics.setdefault(judge_result.model_id, []).append(judge_result.metrics)
+
+    return {
+        'generation': summarize_call_metrics([r.metrics for r in results if r.metrics is not None]),
+        'judges': { model_id: summarize_call_metrics(metrics) for model_id, metrics in judge_metrics.items() }
+    }